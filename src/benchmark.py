@@ -0,0 +1,312 @@
+# Benchmarks the packing pipeline
+#
+# Generates synthetic designs and material databases, runs each stage of the
+# packing pipeline on them and writes the timings to a JSON file, so that the
+# performance of different commits can be compared:
+#
+#   python3 benchmark.py --output before.json
+#   (change things)
+#   python3 benchmark.py --output after.json
+#   python3 benchmark.py --compare before.json after.json
+#
+# Every scenario runs in a fresh process in its own temporary directory, with
+# its own mat-data.txt, colordict2.json and design file, so the benchmark
+# never touches the real material database. The stages are timed separately:
+# loadFile, flattenSVGLayers and splitMaterials (the DOM-based ingest),
+# packaide.pack, merge_sheets, sheet_percentage, writing the packed SVG files
+# and generatePNGPreview, followed by a complete doPacking run.
+
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_FILE = 'benchmark-results.json'
+TIMINGS_FILE = 'timings.json'
+REGRESSION_THRESHOLD = 1.2    # Slowdowns above this ratio are reported as regressions
+
+SHEET_WIDTH = 1008
+SHEET_HEIGHT = 864
+
+# Synthetic scenarios. parts is the number of distinct parts in the design,
+# vertices the number of vertices of each part, and holes the number of holes
+# already cut into each sheet of the material database
+SCENARIOS = [
+  {'name': 'small', 'parts': 10, 'vertices': 8, 'materials': 1, 'copies': 1, 'sheets': 1, 'holes': 0},
+  {'name': 'medium', 'parts': 40, 'vertices': 16, 'materials': 3, 'copies': 2, 'sheets': 2, 'holes': 10},
+  {'name': 'large', 'parts': 120, 'vertices': 24, 'materials': 4, 'copies': 3, 'sheets': 4, 'holes': 30},
+  {'name': 'complex-parts', 'parts': 30, 'vertices': 128, 'materials': 2, 'copies': 1, 'sheets': 2, 'holes': 5},
+  {'name': 'dense-holes', 'parts': 30, 'vertices': 8, 'materials': 2, 'copies': 1, 'sheets': 3, 'holes': 120},
+  {'name': 'many-materials', 'parts': 60, 'vertices': 8, 'materials': 12, 'copies': 1, 'sheets': 1, 'holes': 10},
+]
+
+STAGES = ['loadFile', 'flattenSVGLayers', 'splitMaterials', 'packaide.pack', 'merge_sheets',
+          'sheet_percentage', 'file output', 'generatePNGPreview', 'doPacking']
+
+# Return the points attribute of a random star-shaped polygon with the given
+# number of vertices, centred on the given point
+def polygonPoints(rng, cx, cy, radius, vertices):
+  points = []
+  for i in range(vertices):
+    angle = 2 * math.pi * i / vertices
+    r = radius * rng.uniform(0.6, 1.0)
+    points.append('{:.2f},{:.2f}'.format(cx + r * math.cos(angle), cy + r * math.sin(angle)))
+  return ' '.join(points)
+
+# Return the names and fills of the synthetic materials
+def makeMaterials(count):
+  return [('3mm-bench{}-acrylic'.format(i), 'fill:#{:06x}'.format(0x102030 + 0x0b1d07 * i)) for i in range(count)]
+
+# Write the synthetic material database of the given scenario
+def writeMaterialDB(rng, scenario, materials):
+  fillmappings = {}
+  materialinfo = {}
+  materialsheets = {}
+  colours = {}
+  for matname, fill in materials:
+    fillmappings[fill] = matname
+    colours[matname] = fill
+    materialinfo[matname] = {
+      'width': str(SHEET_WIDTH),
+      'height': str(SHEET_HEIGHT),
+      'viewBox': '0 0 {} {}'.format(SHEET_WIDTH, SHEET_HEIGHT)
+    }
+    sheets = []
+    for sheetid in range(scenario['sheets']):
+      holes = []
+      for hole in range(scenario['holes']):
+        cx = rng.uniform(40, SHEET_WIDTH - 40)
+        cy = rng.uniform(40, SHEET_HEIGHT - 40)
+        holes.append('<polygon points="{}"/>'.format(polygonPoints(rng, cx, cy, rng.uniform(8, 30), 8)))
+      sheets.append('<svg xmlns="http://www.w3.org/2000/svg" width="{0}" height="{1}" viewBox="0 0 {0} {1}">{2}</svg>'.format(
+        SHEET_WIDTH, SHEET_HEIGHT, ''.join(holes)))
+    materialsheets[matname] = sheets
+
+  with open('mat-data.txt', 'w') as outfile:
+    json.dump({'fillmappings': fillmappings, 'materialinfo': materialinfo, 'materialsheets': materialsheets}, outfile)
+  with open('colordict2.json', 'w') as outfile:
+    json.dump(colours, outfile)
+
+# Write the synthetic design of the given scenario. Parts are spread over
+# the materials and over two layers
+def writeDesign(rng, scenario, materials):
+  layers = [[], []]
+  for part in range(scenario['parts']):
+    _, fill = materials[part % len(materials)]
+    points = polygonPoints(rng, rng.uniform(0, 2000), rng.uniform(0, 2000), rng.uniform(15, 60), scenario['vertices'])
+    layers[part % 2].append('<polygon style="{}" points="{}"/>'.format(fill, points))
+
+  with open('design.svg', 'w') as outfile:
+    outfile.write('<?xml version="1.0" encoding="utf-8"?>\n')
+    outfile.write('<svg xmlns="http://www.w3.org/2000/svg" x="0px" y="0px" viewBox="0 0 2000 2000">\n')
+    outfile.write('<title>benchmark</title>\n')
+    for layerid, layer in enumerate(layers):
+      outfile.write('<g id="Layer_{}">\n{}\n</g>\n'.format(layerid + 1, '\n'.join(layer)))
+    outfile.write('</svg>\n')
+
+# Create the working directory of the given scenario
+def prepareScenario(scenario, seed, directory):
+  rng = random.Random('{}-{}'.format(seed, scenario['name']))
+  cwd = os.getcwd()
+  os.chdir(directory)
+  try:
+    materials = makeMaterials(scenario['materials'])
+    writeMaterialDB(rng, scenario, materials)
+    writeDesign(rng, scenario, materials)
+    os.makedirs(os.path.join('FabricaideUI', 'data', 'packed'))
+    os.makedirs('cuts')
+  finally:
+    os.chdir(cwd)
+
+# Time every stage of the pipeline for the scenario in the current directory.
+# Runs in the scenario's own process (see runScenario())
+def measureScenario(scenario, repeat):
+  sys.path.insert(0, SRC_DIR)
+  import fabricade_packing
+
+  job = fabricade_packing.PackingJob(workers=1)
+  runs = {stage: [] for stage in STAGES}
+  counts = {}
+
+  def timed(stage, function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    timings[stage] = timings.get(stage, 0) + time.perf_counter() - start
+    return result
+
+  for run in range(repeat):
+    # Every run starts cold, so that no stage benefits from the previous run
+    job.reset_cache()
+    job.geometrycache.clear()
+    if os.path.exists(job.previews.cachedir):
+      shutil.rmtree(job.previews.cachedir)
+    job.previews.cachesize = None
+    timings = {}
+
+    timed('loadFile', job.loadFile, 'design.svg', scenario['copies'])
+    job.svginput = timed('flattenSVGLayers', job.flattenSVGLayers)
+    timed('splitMaterials', job.splitMaterials, scenario['copies'])
+
+    job.previewjobs = []
+    numsheets = 0
+    for material in job.materials:
+      sheets, shapes, _ = job.planPacking(material)
+      packed, success_fits, num_failed_fits = timed('packaide.pack', fabricade_packing.packShapes, sheets, shapes)
+      timed('merge_sheets', job.merge_sheets, sheets, packed)
+      timed('sheet_percentage', job.sheet_percentage, material, packed)
+
+      def writeFiles():
+        outputs = []
+        for sheetid, svg in packed:
+          svg_output = os.path.join(job.outputdir, '{}_{}.svg'.format(material, sheetid))
+          with open(svg_output, 'w') as cutfile:
+            cutfile.write(svg)
+          outputs.append((sheetid, svg_output))
+        return outputs
+
+      def renderPreviews(outputs):
+        for sheetid, svg_output in outputs:
+          job.generatePNGPreview(svg_output, material, sheetid)
+        job.previews.wait(job.previewjobs)
+        job.previewjobs = []
+
+      outputs = timed('file output', writeFiles)
+      timed('generatePNGPreview', renderPreviews, outputs)
+      numsheets += len(packed)
+
+    # The whole pipeline as the service runs it, again starting cold
+    job.reset_cache()
+    job.geometrycache.clear()
+    shutil.rmtree(job.previews.cachedir, ignore_errors=True)
+    job.previews.cachesize = None
+    job.loadFile('design.svg', scenario['copies'])
+    timed('doPacking', job.doPacking)
+
+    for stage in STAGES:
+      runs[stage].append(timings.get(stage, 0))
+    counts = {
+      'parts': sum(sum(counts) for counts in job.partcounts.values()),
+      'materials': len(job.materials),
+      'packed_sheets': numsheets,
+      'failed_fits': sum(job.failed_fits.values()),
+      'crashed': len(job.crashedmaterials)
+    }
+
+  job.shutdownPool()
+  return {'counts': counts, 'runs': runs}
+
+# Run the given scenario in a new process and return its results
+def runScenario(scenario, repeat, seed, keep):
+  directory = tempfile.mkdtemp(prefix='fabricaide-bench-{}-'.format(scenario['name']))
+  try:
+    prepareScenario(scenario, seed, directory)
+    command = [sys.executable, os.path.abspath(__file__), '--measure', json.dumps(scenario), '--repeat', str(repeat)]
+    with open(os.path.join(directory, 'log.txt'), 'w') as log:
+      subprocess.run(command, cwd=directory, stdout=log, stderr=subprocess.STDOUT, check=True)
+    with open(os.path.join(directory, TIMINGS_FILE)) as infile:
+      measured = json.load(infile)
+  except subprocess.CalledProcessError:
+    print('Scenario {} failed, see {}'.format(scenario['name'], os.path.join(directory, 'log.txt')))
+    return None
+  finally:
+    if not keep and os.path.exists(os.path.join(directory, TIMINGS_FILE)):
+      shutil.rmtree(directory)
+
+  stages = {}
+  for stage, runs in measured['runs'].items():
+    stages[stage] = {
+      'min': min(runs),
+      'median': statistics.median(runs),
+      'mean': statistics.mean(runs),
+      'runs': runs
+    }
+  return {'params': scenario, 'counts': measured['counts'], 'stages': stages}
+
+# Return the commit that is being benchmarked, if known
+def currentCommit():
+  try:
+    return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=SRC_DIR, capture_output=True, text=True, check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+# Print the change in the median time of every stage between two result
+# files. Returns True if no stage got slower than the threshold allows
+def compareResults(basefile, newfile, threshold):
+  with open(basefile) as infile:
+    base = json.load(infile)
+  with open(newfile) as infile:
+    new = json.load(infile)
+
+  print('{:<16} {:<20} {:>10} {:>10} {:>8}'.format('scenario', 'stage', 'base (s)', 'new (s)', 'ratio'))
+  ok = True
+  for name, scenario in new['scenarios'].items():
+    if name not in base['scenarios']:
+      continue
+    for stage, timing in scenario['stages'].items():
+      before = base['scenarios'][name]['stages'].get(stage)
+      if before is None:
+        continue
+      ratio = timing['median'] / before['median'] if before['median'] > 0 else float('inf')
+      flag = ''
+      if ratio > threshold:
+        flag = '  <-- regression'
+        ok = False
+      print('{:<16} {:<20} {:>10.4f} {:>10.4f} {:>8.2f}{}'.format(name, stage, before['median'], timing['median'], ratio, flag))
+  return ok
+
+if __name__ == "__main__":
+  argparser = argparse.ArgumentParser()
+  argparser.add_argument('--output', dest='output', default=RESULTS_FILE, help='JSON file to write the results to')
+  argparser.add_argument('--scenario', dest='scenarios', action='append', help='Only run the named scenario (may be given several times)')
+  argparser.add_argument('--repeat', dest='repeat', default=3, type=int, help='Number of times each scenario is run')
+  argparser.add_argument('--seed', dest='seed', default=0, type=int, help='Seed for the synthetic designs and databases')
+  argparser.add_argument('--keep', dest='keep', action='store_true', help='Keep the working directories of the scenarios')
+  argparser.add_argument('--compare', dest='compare', nargs=2, metavar=('BASE', 'NEW'), help='Compare two result files instead of running')
+  argparser.add_argument('--threshold', dest='threshold', default=REGRESSION_THRESHOLD, type=float, help='Slowdown ratio reported as a regression')
+  argparser.add_argument('--measure', dest='measure', default=None, help=argparse.SUPPRESS)
+  args = argparser.parse_args()
+
+  if args.compare is not None:
+    sys.exit(0 if compareResults(args.compare[0], args.compare[1], args.threshold) else 1)
+
+  # Inside the process of a single scenario
+  if args.measure is not None:
+    measured = measureScenario(json.loads(args.measure), args.repeat)
+    with open(TIMINGS_FILE, 'w') as outfile:
+      json.dump(measured, outfile)
+    sys.exit(0)
+
+  scenarios = SCENARIOS
+  if args.scenarios:
+    scenarios = [scenario for scenario in SCENARIOS if scenario['name'] in args.scenarios]
+
+  results = {
+    'commit': currentCommit(),
+    'timestamp': time.time(),
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'repeat': args.repeat,
+    'seed': args.seed,
+    'scenarios': {}
+  }
+  for scenario in scenarios:
+    print('Running scenario {}...'.format(scenario['name']))
+    result = runScenario(scenario, args.repeat, args.seed, args.keep)
+    if result is None:
+      continue
+    results['scenarios'][scenario['name']] = result
+    for stage in STAGES:
+      print('  {:<20} {:.4f}s'.format(stage, result['stages'][stage]['median']))
+
+  with open(args.output, 'w') as outfile:
+    json.dump(results, outfile, indent=2)
+  print('Results written to {}'.format(args.output))
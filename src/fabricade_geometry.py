@@ -0,0 +1,119 @@
+# Cache of the geometry of the material sheets
+#
+# Parsing a sheet and extracting the polygons of its holes is expensive,
+# but the holes of a sheet only change when the sheet is rewritten in the
+# material database (e.g. by fabricade_svgutils.updateMaterialHoles). The
+# geometry of every sheet is therefore cached against the version of the
+# sheet in the material database, and is only recomputed once that sheet
+# has been rewritten.
+#
+# Provides:
+#   SheetGeometry: the parsed sheet, its hole polygons and their unions
+#   GeometryCache: a cache of SheetGeometry keyed by material, sheet ID
+#     and sheet version
+#   geometrycache: the GeometryCache shared by all of Fabricaide
+
+import itertools
+import packaide
+import shapely.geometry
+import shapely.ops
+import threading
+import xml.dom.minidom as DOM
+
+import fabricade_matdb
+
+# Offset applied to the shapes when measuring the consumed area of a sheet
+OFFSET = 20
+
+# Return the union of the given (polygon, holes) pairs and the union of
+# their holes, or (None, None) if there are no polygons
+def unionWithHoles(shapely_polygons):
+  if len(shapely_polygons) == 0:
+    return None, None
+  polygons, holes_list = zip(*shapely_polygons)
+  union = shapely.ops.unary_union(polygons)
+  hole_union = shapely.ops.unary_union(list(itertools.chain(*holes_list)))
+  return union, hole_union
+
+class SheetGeometry:
+  def __init__(self, svg, offset=OFFSET):
+    height, width = packaide.get_sheet_dimensions(svg)
+    self.width = width
+    self.height = height
+    self.boundary = shapely.geometry.Polygon([(0,0),(width,0),(height,width),(0, height)])
+
+    # The holes that have already been cut out of the sheet
+    _, self.polygons = packaide.extract_shapely_polygons(svg, offset)
+    self.union, self.holeUnion = unionWithHoles(self.polygons)
+
+    # The parsed sheet, for building previews. Clone it before modifying it
+    self.root = DOM.parseString(svg).getElementsByTagName('svg')[0]
+
+  # Return the union of the holes of the sheet and the given additional
+  # (polygon, holes) pairs, and the union of their holes, or (None, None) if
+  # there are none
+  def consumedRegion(self, shapely_polygons=()):
+    union, hole_union = self.union, self.holeUnion
+    if len(shapely_polygons) > 0:
+      packed_union, packed_holes = unionWithHoles(shapely_polygons)
+      if union is None:
+        union, hole_union = packed_union, packed_holes
+      else:
+        union = shapely.ops.unary_union([union, packed_union])
+        hole_union = shapely.ops.unary_union([hole_union, packed_holes])
+    return union, hole_union
+
+  # Return the area of the sheet that is consumed by its holes together
+  # with the given additional (polygon, holes) pairs
+  def consumedArea(self, shapely_polygons=()):
+    union, hole_union = self.consumedRegion(shapely_polygons)
+    if union is None:
+      return 0
+    return self.boundary.intersection(union.difference(hole_union)).area
+
+  # Return the list of separate regions of the sheet that are neither cut
+  # out nor covered by the given additional (polygon, holes) pairs
+  def freeRegions(self, shapely_polygons=()):
+    free = shapely.geometry.box(0, 0, self.width, self.height)
+    union, hole_union = self.consumedRegion(shapely_polygons)
+    if union is not None:
+      free = free.difference(union.difference(hole_union))
+    if free.is_empty:
+      return []
+    return list(getattr(free, 'geoms', [free]))
+
+  # Return the area of the sheet that has not been cut out yet
+  def freeArea(self):
+    return self.boundary.area - self.consumedArea()
+
+class GeometryCache:
+  def __init__(self, materialdb=None):
+    self.materialdb = materialdb if materialdb is not None else fabricade_matdb.materialdb
+    self.lock = threading.Lock()
+
+    # Map from (material, sheet ID, offset) to (sheet version, SheetGeometry).
+    # Only the most recent version of each sheet is kept
+    self.geometries = {}
+
+  # Return the geometry of the given sheet, computing it if the sheet
+  # has changed since it was last computed
+  def get(self, material, sheetid, offset=OFFSET):
+    key = (material, sheetid, offset)
+    version = self.materialdb.sheetVersion(material, sheetid)
+    with self.lock:
+      cached = self.geometries.get(key)
+      if cached is not None and cached[0] == version:
+        return cached[1]
+
+    geometry = SheetGeometry(self.materialdb.getSheet(material, sheetid), offset)
+    with self.lock:
+      self.geometries[key] = (version, geometry)
+    return geometry
+
+  # Forget the geometry of every sheet
+  def clear(self):
+    with self.lock:
+      self.geometries = {}
+
+# The sheet geometry shared by all of Fabricaide
+geometrycache = GeometryCache()
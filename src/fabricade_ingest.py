@@ -0,0 +1,88 @@
+# Fast ingest of design files
+#
+# Reads an SVG design with the expat parser directly instead of building a
+# DOM of the whole document and moving its nodes around. Layers (groups) are
+# flattened while parsing, so a single pass yields the root element and the
+# list of shapes in the same order that PackingJob.flattenSVGLayers leaves
+# them in. Only the shapes themselves are needed for packing (parts are
+# shallow copies), so the contents of the shapes are skipped entirely.
+#
+# Provides:
+#   readDesign: parse a design into its root attributes and flattened shapes
+#   makeElement: create a DOM element from a tag and attribute list
+
+import xml.parsers.expat
+
+# Read the given SVG design file. Returns the attributes of the root svg
+# element and a list of (tag, attributes) pairs for the shapes in the
+# flattened design. Attributes are lists of (name, value) pairs in the
+# order that the DOM would hold them.
+#
+# Flattening matches PackingJob.flattenSVGLayers: the shapes directly
+# inside the root come first, followed by the contents of each layer in
+# document order. Titles are dropped.
+def readDesign(filename):
+  rootattrs = None
+  rootshapes = []
+  layers = []
+
+  # For each open element, the list that its children belong in, or
+  # None if its children are not part of the design
+  stack = []
+
+  def start_element(tag, attrs):
+    nonlocal rootattrs
+    attrs = orderAttributes(attrs)
+
+    if rootattrs is None:
+      if tag != 'svg':
+        stack.append(None)
+        return
+      rootattrs = attrs
+      stack.append(rootshapes)
+      return
+
+    parent = stack[-1] if len(stack) > 0 else None
+    if parent is None:
+      stack.append(None)
+    elif tag == 'g':
+      layer = []
+      layers.append(layer)
+      stack.append(layer)
+    else:
+      if tag != 'title':
+        parent.append((tag, attrs))
+      stack.append(None)
+
+  def end_element(tag):
+    stack.pop()
+
+  parser = xml.parsers.expat.ParserCreate()
+  parser.ordered_attributes = True
+  parser.StartElementHandler = start_element
+  parser.EndElementHandler = end_element
+  with open(filename, 'rb') as infile:
+    parser.ParseFile(infile)
+
+  shapes = rootshapes
+  for layer in layers:
+    shapes.extend(layer)
+  return rootattrs, shapes
+
+# Convert a flat [name, value, name, value, ...] attribute list from expat
+# into (name, value) pairs. The DOM puts namespace declarations before the
+# other attributes, so they are moved to the front
+def orderAttributes(attrs):
+  pairs = list(zip(attrs[0::2], attrs[1::2]))
+  namespaces = [pair for pair in pairs if pair[0] == 'xmlns' or pair[0].startswith('xmlns:')]
+  if len(namespaces) == 0:
+    return pairs
+  return namespaces + [pair for pair in pairs if not (pair[0] == 'xmlns' or pair[0].startswith('xmlns:'))]
+
+# Create an element of the given DOM document with the given tag and
+# (name, value) attribute pairs
+def makeElement(doc, tag, attrs):
+  element = doc.createElement(tag)
+  for name, value in attrs:
+    element.setAttribute(name, value)
+  return element
@@ -0,0 +1,318 @@
+# Queue of packing jobs shared by several operators
+#
+# Every submitted design becomes a job with its own ID and its own output
+# directories, so jobs never overwrite each other's packed files. Jobs wait
+# in a queue and are started in order of priority (then submission), while
+# limiting the number of jobs running at once, both overall and per user.
+#
+# Jobs are recorded in the shared state store, so that they can be submitted
+# to and queried from any process serving the REST API. Only the process
+# that holds the packer lease starts them (see fabricade_worker). Each job
+# runs in a process of its own, so that jobs pack side by side rather than
+# taking turns at the interpreter lock, and follows its record in the store
+# to learn when it has been cancelled.
+#
+# Finished jobs are moved off the list of queued and running jobs, so that
+# the scheduler only ever looks at the jobs that still need it. Only the
+# most recent MAX_FINISHED_JOBS finished jobs are kept in the store, though
+# their directories are left on disk.
+#
+# A running job is owned by the process that started it. If that process
+# stops holding the packer lease before the job finishes, the next holder
+# queues the job again, counting how often it has been started. Only the
+# most recent start of a job may record its outcome, and an earlier one
+# that is still running stops once it notices it has been superseded.
+#
+# The single packing job that the Fabricaide UI drives through /process
+# and /check_refresh is available as the job DEFAULT_JOB.
+#
+# Provides:
+#   Job: a running packing job
+#   Scheduler: queues and runs jobs
+#   runJob: packs a job (in a job process)
+
+import concurrent.futures
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+import traceback
+import uuid
+
+import fabricade_metrics
+import fabricade_packing
+import fabricade_state
+
+JOBS_DIR = 'jobs'           # Each job's design and outputs live in a directory in here
+MAX_RUNNING_JOBS = 2        # Number of jobs that may run at once
+MAX_JOBS_PER_USER = 1       # Number of jobs that each user may have running at once
+MAX_FINISHED_JOBS = 100     # Number of finished jobs whose records are kept
+MAX_JOB_ATTEMPTS = 3        # Number of times a job is started before it is given up as failed
+DEFAULT_JOB = 'default'     # ID of the job driven by /process
+
+CANCEL_POLL_INTERVAL = 0.5  # Seconds between checks of whether a running job has been cancelled
+
+JOBS_KEY = 'jobs'                   # IDs of the queued and running jobs in the state store
+FINISHED_JOBS_KEY = 'jobs.finished' # IDs of the most recently finished jobs, oldest first
+NEXT_JOB_KEY = 'jobs.next'          # Counter for job IDs in the state store
+FINISHED_STATES = ['done', 'failed', 'cancelled']
+
+# Return the key of the record of the given job in the state store
+def jobKey(jobid):
+  return 'job:' + jobid
+
+# Pack the job with the given record, following its record in the state
+# store at the given path to stop once it has been cancelled or started
+# again elsewhere. Returns the final state of the job and its results. This
+# runs in a job process, so it lives at module level
+def runJob(statepath, record):
+  state = fabricade_state.StateStore(statepath)
+  fabricade_metrics.metrics.share(state)
+  # Jobs run in processes of their own, so each packs its materials serially
+  packing = fabricade_packing.PackingJob(workers=1, outputdir=record['outputdir'], previewdir=record['previewdir'])
+
+  done = threading.Event()
+  def followCancellation():
+    while not done.wait(CANCEL_POLL_INTERVAL):
+      current = state.get(jobKey(record['id']))
+      if current is None or current.get('cancel') or current.get('attempts') != record['attempts']:
+        packing.cancel()
+  follower = threading.Thread(target=followCancellation, daemon=True)
+  follower.start()
+  try:
+    packing.clearPreviews()
+    packing.loadFile(record['svgfile'], record['copies'])
+    packing.doPacking()
+    return ('cancelled' if packing.cancelled else 'done'), packing.results()
+  except Exception:
+    traceback.print_exc()
+    return 'failed', None
+  finally:
+    done.set()
+    follower.join()
+
+class Job:
+  def __init__(self, record):
+    self.id = record['id']
+    self.user = record['user']
+    self.attempt = record['attempts']
+    self.future = None
+
+class Scheduler:
+  def __init__(self, state, defaultjob, slots=MAX_RUNNING_JOBS, peruser=MAX_JOBS_PER_USER):
+    self.state = state
+    self.defaultjob = defaultjob
+    self.slots = slots
+    self.peruser = peruser
+    self.lock = threading.RLock()
+
+    # The jobs that this process is running, and the pool of job processes
+    # they run in (started on demand)
+    self.running = {}
+    self.pool = None
+
+    # Identifies the running jobs that were started by this scheduler (see
+    # owner())
+    self.token = uuid.uuid4().hex
+
+  # Queue a packing job for the given design. Jobs with a higher priority
+  # are started first. Returns the ID of the new job
+  def submit(self, svgfile, copies, user='anonymous', priority=0):
+    jobid = str(self.state.increment(NEXT_JOB_KEY))
+    while os.path.exists(os.path.join(JOBS_DIR, jobid)):
+      jobid = str(self.state.increment(NEXT_JOB_KEY))
+
+    # Keep a snapshot of the design, since the original may keep changing
+    directory = os.path.join(JOBS_DIR, jobid)
+    outputdir = os.path.join(directory, 'cuts')
+    os.makedirs(outputdir)
+    snapshot = os.path.join(directory, 'design.svg')
+    shutil.copyfile(svgfile, snapshot)
+
+    self.state.set(jobKey(jobid), {
+      'id': jobid,
+      'user': user,
+      'priority': priority,
+      'state': 'queued',
+      'copies': copies,
+      'svgfile': snapshot,
+      'submitted': time.time(),
+      'started': None,
+      'finished': None,
+      'outputdir': outputdir,
+      'previewdir': os.path.join(directory, 'packed'),
+      'owner': None,
+      'attempts': 0,
+      'results': None
+    })
+    self.state.update(JOBS_KEY, lambda jobids: jobids + [jobid], [])
+    print('[Jobs] Queued job {} from {}'.format(jobid, user))
+    self.defaultjob.wake()
+    return jobid
+
+  # Return the status of the given job, or None if there is no such job
+  def status(self, jobid):
+    if jobid == DEFAULT_JOB:
+      return self.defaultStatus()
+    return self.state.get(jobKey(jobid))
+
+  # Return the status of every job: the queued and running ones, followed
+  # by the most recently finished ones
+  def statuses(self):
+    jobids = self.state.get(JOBS_KEY, []) + self.state.get(FINISHED_JOBS_KEY, [])
+    jobs = [self.state.get(jobKey(jobid)) for jobid in jobids]
+    return [self.defaultStatus()] + [job for job in jobs if job is not None]
+
+  # Status of the job driven by /process
+  def defaultStatus(self):
+    status = {'id': DEFAULT_JOB}
+    status.update(self.defaultjob.status())
+    return status
+
+  # Cancel the given job. A queued job never starts, and a running job
+  # stops at its next material boundary once its process notices (see
+  # runJob()). Returns False if there is no such job or it has already
+  # finished
+  def cancel(self, jobid):
+    cancelled = []
+    def cancelJob(record):
+      if record is None or record['state'] not in ['queued', 'running']:
+        return record
+      if record['state'] == 'queued':
+        record['state'] = 'cancelled'
+        record['finished'] = time.time()
+      else:
+        record['cancel'] = True
+      cancelled.append(jobid)
+      return record
+    record = self.state.update(jobKey(jobid), cancelJob)
+    if record is not None and record['state'] == 'cancelled':
+      self.retire(jobid)
+    return len(cancelled) > 0
+
+  # Move the given finished job from the list of queued and running jobs to
+  # the finished jobs, forgetting the oldest finished jobs beyond
+  # MAX_FINISHED_JOBS
+  def retire(self, jobid):
+    pruned = []
+    def finish(jobids):
+      jobids = [other for other in jobids if other != jobid] + [jobid]
+      pruned.extend(jobids[:-MAX_FINISHED_JOBS])
+      return jobids[-MAX_FINISHED_JOBS:]
+    self.state.update(FINISHED_JOBS_KEY, finish, [])
+    self.state.update(JOBS_KEY, lambda jobids: [other for other in jobids if other != jobid], [])
+    for old in pruned:
+      self.state.delete(jobKey(old))
+
+  # Return the owner recorded on the jobs that this scheduler starts. This
+  # tells forked processes apart
+  def owner(self):
+    return '{}-{}'.format(os.getpid(), self.token)
+
+  # Start as many queued jobs as the limits allow. Only called in the
+  # process that holds the packer lease
+  def dispatch(self):
+    with self.lock:
+      jobids = self.state.get(JOBS_KEY, [])
+      if len(jobids) == 0:
+        return
+      records = []
+      for jobid in jobids:
+        record = self.state.get(jobKey(jobid))
+        if record is not None and record['state'] == 'running' and record['id'] not in self.running:
+          # Its process stopped holding the lease before the job finished
+          record = self.state.update(jobKey(jobid), lambda current: self.requeue(current, record))
+        if record is None or record['state'] in FINISHED_STATES:
+          self.retire(jobid)
+        else:
+          records.append(record)
+
+      running = [record for record in records if record['state'] == 'running']
+      queued = sorted([record for record in records if record['state'] == 'queued'],
+                      key=lambda record: (-record['priority'], record['submitted']))
+      for record in queued:
+        if len(running) >= self.slots:
+          break
+        if len([other for other in running if other['user'] == record['user']]) >= self.peruser:
+          continue
+        record = self.state.update(jobKey(record['id']), self.claim)
+        if record is None or record['state'] != 'running' or record['owner'] != self.owner():
+          continue
+        job = Job(record)
+        self.running[job.id] = job
+        running.append(record)
+        self.start(job, record)
+
+  # Return the given record of a queued job, marked as running in this
+  # process, unless it has changed since it was read
+  def claim(self, record):
+    if record is not None and record['state'] == 'queued':
+      record.update(state='running', started=time.time(), owner=self.owner(), attempts=record.get('attempts', 0) + 1)
+    return record
+
+  # Return the given current record of a running job whose process has
+  # stopped holding the lease, queued again, or given up as failed once it
+  # has been started MAX_JOB_ATTEMPTS times. The job is left alone if it has
+  # changed since its record was seen as the given one, e.g. because it has
+  # finished in the meantime
+  def requeue(self, record, seen):
+    if record is None or record['state'] != 'running' or record.get('attempts') != seen.get('attempts'):
+      return record
+    if record.get('cancel'):
+      record.update(state='cancelled', finished=time.time())
+    elif record.get('attempts', 0) >= MAX_JOB_ATTEMPTS:
+      record.update(state='failed', finished=time.time())
+    else:
+      record.update(state='queued', started=None, owner=None)
+    return record
+
+  # Return the pool of job processes, starting it if necessary. Like the
+  # packing workers, they are started from a fork server (see
+  # PackingJob.getPool())
+  def getPool(self):
+    if self.pool is None:
+      self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.slots, mp_context=multiprocessing.get_context('forkserver'))
+    return self.pool
+
+  # Start packing the given job, with the given record, in a job process
+  def start(self, job, record):
+    print('[Jobs] Starting job {}'.format(job.id))
+    try:
+      job.future = self.getPool().submit(runJob, self.state.path, record)
+    except Exception as e:
+      self.failed(e)
+      job.future = concurrent.futures.Future()
+      job.future.set_exception(e)
+    job.future.add_done_callback(lambda future: self.finish(job, future))
+
+  # Record the outcome of the given job once its process is done with it
+  def finish(self, job, future):
+    try:
+      state, results = future.result()
+    except Exception as e:
+      print('[Jobs] Job {} crashed: {}'.format(job.id, e))
+      self.failed(e)
+      state, results = 'failed', None
+
+    # The job may have been started again elsewhere in the meantime, in
+    # which case only the newest start records its outcome
+    def complete(record):
+      if record is not None and record['state'] == 'running' and record.get('attempts') == job.attempt:
+        record.update(state=state, results=results, finished=time.time())
+      return record
+    with self.lock:
+      record = self.state.update(jobKey(job.id), complete)
+      del self.running[job.id]
+    if record is not None and record['state'] in FINISHED_STATES:
+      self.retire(job.id)
+    print('[Jobs] Job {} is {}'.format(job.id, state))
+    # The next queued job can start
+    self.defaultjob.wake()
+
+  # A job process that died takes the whole pool down with it, so the next
+  # job starts a new one
+  def failed(self, error):
+    if isinstance(error, concurrent.futures.BrokenExecutor) and self.pool is not None:
+      self.pool.shutdown(wait=False)
+      self.pool = None
@@ -0,0 +1,402 @@
+# Storage engine for the material database
+#
+# The material database is kept in an SQLite database in WAL mode with one
+# row per material sheet. Writes only touch the sheets that changed and run
+# in a transaction, so concurrent readers never see a half-written database.
+# The database carries a version number that is bumped by every write, and
+# every sheet records the database version at which it was last written.
+#
+# The data is presented in the same format as the original JSON database
+# (mat-data.txt), a dictionary with the keys
+#   fillmappings: map from fill styles to material names
+#   materialinfo: map from material names to their dimensions
+#   materialsheets: map from material names to lists of SVG sheets
+# If the database does not exist yet, it is imported from the JSON file.
+#
+# Provides:
+#   MaterialStore: read and write access to the material database
+#   MaterialDB: an in-memory cache of the material database that is only
+#     reloaded when the database changes
+#   materialdb: the MaterialDB shared by all of Fabricaide
+#
+# Can also be run as a script to convert between the two formats:
+#   python3 fabricade_matdb.py import mat-data.txt
+#   python3 fabricade_matdb.py export mat-data.txt
+
+import argparse
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import traceback
+
+MAT_DB = 'mat-data.db'          # Material database
+MAT_DB_JSON = 'mat-data.txt'    # Material database in the original JSON format
+
+SCHEMA = """
+  CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+  CREATE TABLE IF NOT EXISTS fillmappings (fill TEXT PRIMARY KEY, material TEXT NOT NULL, position INTEGER NOT NULL);
+  CREATE TABLE IF NOT EXISTS materials (name TEXT PRIMARY KEY, info TEXT, position INTEGER NOT NULL);
+  CREATE TABLE IF NOT EXISTS sheets (material TEXT NOT NULL, sheetid INTEGER NOT NULL, svg TEXT NOT NULL,
+                                     version INTEGER NOT NULL, PRIMARY KEY (material, sheetid));
+"""
+
+class MaterialStore:
+  def __init__(self, path=MAT_DB, jsonpath=MAT_DB_JSON):
+    self.path = path
+    self.jsonpath = jsonpath
+
+    # The database is created lazily on first use
+    self.initialized = False
+    self.initLock = threading.Lock()
+
+  # Open a new connection to the database. Connections are not shared
+  # between threads, so every operation uses its own
+  def connect(self):
+    if not self.initialized:
+      self.initialize()
+    return self.open()
+
+  def open(self):
+    conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+  # Create the database if necessary, importing the JSON database
+  # if there is one
+  def initialize(self):
+    with self.initLock:
+      if self.initialized:
+        return
+      exists = os.path.exists(self.path)
+      conn = self.open()
+      try:
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(SCHEMA)
+      finally:
+        conn.close()
+      self.initialized = True
+
+    if not exists and os.path.exists(self.jsonpath):
+      print('[MatDB] Importing the material database from {}'.format(self.jsonpath))
+      self.importJSON(self.jsonpath)
+
+  # Run the body in a read transaction, so that all queries in it
+  # see the same snapshot of the database
+  @contextlib.contextmanager
+  def snapshot(self):
+    conn = self.connect()
+    try:
+      conn.execute('BEGIN')
+      yield conn
+      conn.execute('COMMIT')
+    finally:
+      conn.close()
+
+  # Run the body in a write transaction. Yields the connection and the
+  # new version number of the database
+  @contextlib.contextmanager
+  def transaction(self):
+    conn = self.connect()
+    try:
+      conn.execute('BEGIN IMMEDIATE')
+      version = self.readVersion(conn) + 1
+      conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)", (version,))
+      yield conn, version
+      conn.execute('COMMIT')
+    except:
+      conn.execute('ROLLBACK')
+      raise
+    finally:
+      conn.close()
+
+  def readVersion(self, conn):
+    row = conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+    return row[0] if row is not None else 0
+
+  # Return the version number of the database
+  def version(self):
+    conn = self.connect()
+    try:
+      return self.readVersion(conn)
+    finally:
+      conn.close()
+
+  # Return the whole database in the JSON format
+  def load(self):
+    with self.snapshot() as conn:
+      return self.readAll(conn)
+
+  def readAll(self, conn):
+    fillmappings = {fill: material for fill, material in
+                    conn.execute('SELECT fill, material FROM fillmappings ORDER BY position')}
+    materials = conn.execute('SELECT name, info FROM materials ORDER BY position').fetchall()
+    materialinfo = {name: json.loads(info) for name, info in materials if info is not None}
+    materialsheets = {}
+    for material, svg in conn.execute('SELECT sheets.material, sheets.svg FROM sheets JOIN materials ON sheets.material = materials.name '
+                                      'ORDER BY materials.position, sheets.sheetid'):
+      materialsheets.setdefault(material, []).append(svg)
+    return {'fillmappings': fillmappings, 'materialinfo': materialinfo, 'materialsheets': materialsheets}
+
+  # Return the SVG string of the given sheet
+  def getSheet(self, matname, sheetid):
+    conn = self.connect()
+    try:
+      row = conn.execute('SELECT svg FROM sheets WHERE material = ? AND sheetid = ?', (matname, sheetid)).fetchone()
+    finally:
+      conn.close()
+    if row is None:
+      raise KeyError('No sheet {} for material {}'.format(sheetid, matname))
+    return row[0]
+
+  # Return a map from sheet IDs to the version at which they were last
+  # written for the given material, or for all materials if none is given
+  # (in which case the map is keyed by (material, sheet ID))
+  def sheetVersions(self, matname=None):
+    conn = self.connect()
+    try:
+      if matname is None:
+        return self.readSheetVersions(conn)
+      return {sheetid: version for sheetid, version in
+              conn.execute('SELECT sheetid, version FROM sheets WHERE material = ?', (matname,))}
+    finally:
+      conn.close()
+
+  def readSheetVersions(self, conn):
+    return {(material, sheetid): version for material, sheetid, version in
+            conn.execute('SELECT material, sheetid, version FROM sheets')}
+
+  # Overwrite the given sheet. Returns the new version of the database
+  def setSheet(self, matname, sheetid, svg):
+    with self.transaction() as (conn, version):
+      cursor = conn.execute('UPDATE sheets SET svg = ?, version = ? WHERE material = ? AND sheetid = ?',
+                            (svg, version, matname, sheetid))
+      if cursor.rowcount == 0:
+        raise KeyError('No sheet {} for material {}'.format(sheetid, matname))
+    return version
+
+  # Add a new sheet at the end of the sheets of the given material.
+  # Returns the new version of the database
+  def appendSheet(self, matname, svg):
+    with self.transaction() as (conn, version):
+      count = conn.execute('SELECT COUNT(*) FROM sheets WHERE material = ?', (matname,)).fetchone()[0]
+      self.ensureMaterial(conn, matname)
+      conn.execute('INSERT INTO sheets (material, sheetid, svg, version) VALUES (?, ?, ?, ?)',
+                   (matname, count, svg, version))
+    return version
+
+  # Add a new sheet at the given position among the sheets of the given
+  # material. The sheets after it move up by one, which counts as a change
+  # to each of them. Returns the new version of the database
+  def insertSheet(self, matname, index, svg):
+    with self.transaction() as (conn, version):
+      self.ensureMaterial(conn, matname)
+      # Shift in two steps to avoid clashing with the primary key
+      conn.execute('UPDATE sheets SET sheetid = -(sheetid + 1), version = ? WHERE material = ? AND sheetid >= ?',
+                   (version, matname, index))
+      conn.execute('UPDATE sheets SET sheetid = -sheetid WHERE material = ? AND sheetid < 0', (matname,))
+      conn.execute('INSERT INTO sheets (material, sheetid, svg, version) VALUES (?, ?, ?, ?)',
+                   (matname, index, svg, version))
+    return version
+
+  # Make sure that the given material has a row, so that its sheets are listed
+  def ensureMaterial(self, conn, matname):
+    position = conn.execute('SELECT COALESCE(MAX(position), -1) + 1 FROM materials').fetchone()[0]
+    conn.execute('INSERT OR IGNORE INTO materials (name, info, position) VALUES (?, NULL, ?)', (matname, position))
+
+  # Replace the contents of the database with the given JSON database
+  def importJSON(self, filename):
+    with open(filename, 'r') as infile:
+      matdb = json.load(infile)
+
+    with self.transaction() as (conn, version):
+      for table in ['fillmappings', 'materials', 'sheets']:
+        conn.execute('DELETE FROM {}'.format(table))
+
+      conn.executemany('INSERT INTO fillmappings (fill, material, position) VALUES (?, ?, ?)',
+                       [(fill, material, position) for position, (fill, material) in enumerate(matdb['fillmappings'].items())])
+
+      names = list(matdb['materialinfo'].keys())
+      names += [material for material in matdb['materialsheets'] if material not in matdb['materialinfo']]
+      conn.executemany('INSERT INTO materials (name, info, position) VALUES (?, ?, ?)',
+                       [(name, json.dumps(matdb['materialinfo'][name]) if name in matdb['materialinfo'] else None, position)
+                        for position, name in enumerate(names)])
+
+      conn.executemany('INSERT INTO sheets (material, sheetid, svg, version) VALUES (?, ?, ?, ?)',
+                       [(material, sheetid, svg, version)
+                        for material, sheets in matdb['materialsheets'].items()
+                        for sheetid, svg in enumerate(sheets)])
+    return version
+
+  # Write the contents of the database out as a JSON database
+  def exportJSON(self, filename):
+    matdb = self.load()
+    with open(filename, 'w') as outfile:
+      json.dump(matdb, outfile)
+
+# In-memory copy of the material database. Queries are answered from memory,
+# and the database is only read again when its files have changed and its
+# version shows that somebody else has written to it. Writes made through
+# the cache update it directly.
+#
+# The dictionary returned by load() must be treated as read-only. Writes
+# replace it with an updated copy, so a caller holding on to it keeps a
+# consistent view of the database.
+class MaterialDB:
+  def __init__(self, store=None):
+    self.store = store if store is not None else MaterialStore()
+    self.lock = threading.Lock()
+    self.data = None          # The database in the JSON format
+    self.versions = None      # Map from (material, sheet ID) to sheet versions
+    self.dbversion = None     # Version of the database that is cached
+    self.signature = None     # Modification times and sizes of the database files
+    self.listeners = []       # Functions called after every write (see addListener())
+
+  # Return the modification times and sizes of the database files
+  def fileSignature(self):
+    signature = []
+    for path in [self.store.path, self.store.path + '-wal']:
+      try:
+        stat = os.stat(path)
+        signature.append((stat.st_mtime_ns, stat.st_size))
+      except OSError:
+        signature.append(None)
+    return tuple(signature)
+
+  # Bring the cache up to date with the database. Must hold the lock
+  def refresh(self):
+    signature = self.fileSignature()
+    if self.data is not None and signature == self.signature:
+      return
+
+    # The files have changed, but that may just be our own write
+    if self.data is None or self.store.version() != self.dbversion:
+      print('[MatDB] Loading the material database')
+      with self.store.snapshot() as conn:
+        self.data = self.store.readAll(conn)
+        self.versions = self.store.readSheetVersions(conn)
+        self.dbversion = self.store.readVersion(conn)
+    self.signature = signature
+
+  # Return the whole database in the JSON format
+  def load(self):
+    with self.lock:
+      self.refresh()
+      return self.data
+
+  # Return the version number of the database
+  def version(self):
+    with self.lock:
+      self.refresh()
+      return self.dbversion
+
+  # Return the SVG string of the given sheet
+  def getSheet(self, matname, sheetid):
+    return self.load()['materialsheets'][matname][sheetid]
+
+  # Return the version at which the given sheet was last written
+  def sheetVersion(self, matname, sheetid):
+    with self.lock:
+      self.refresh()
+      return self.versions[(matname, sheetid)]
+
+  # Return a map from (material, sheet ID) to the version at which
+  # each sheet was last written
+  def sheetVersions(self):
+    with self.lock:
+      self.refresh()
+      return self.versions
+
+  # Replace the cached sheets of the given material after a write that
+  # produced the given database version. If somebody else has written to
+  # the database since it was cached, the cache is dropped instead
+  def update(self, matname, sheets, versions, version):
+    if self.data is None or self.dbversion != version - 1:
+      self.data = None
+      return
+
+    data = dict(self.data)
+    data['materialsheets'] = dict(data['materialsheets'])
+    data['materialsheets'][matname] = sheets
+    self.versions = dict(self.versions)
+    self.versions.update({(matname, sheetid): sheetversion for sheetid, sheetversion in versions.items()})
+    self.data = data
+    self.dbversion = version
+
+  # Call the given function after every write to the database made through
+  # this cache. Writes made by other processes are not announced
+  def addListener(self, listener):
+    self.listeners.append(listener)
+
+  # Call the listeners after a write. Must not hold the lock, since they
+  # usually read the database
+  def notify(self):
+    for listener in self.listeners:
+      try:
+        listener()
+      except Exception:
+        traceback.print_exc()
+
+  # Overwrite the given sheet. Returns the new version of the database
+  def setSheet(self, matname, sheetid, svg):
+    with self.lock:
+      self.refresh()
+      version = self.store.setSheet(matname, sheetid, svg)
+      sheets = list(self.data['materialsheets'][matname])
+      sheets[sheetid] = svg
+      self.update(matname, sheets, {sheetid: version}, version)
+    self.notify()
+    return version
+
+  # Add a new sheet at the end of the sheets of the given material.
+  # Returns the new version of the database
+  def appendSheet(self, matname, svg):
+    with self.lock:
+      self.refresh()
+      version = self.store.appendSheet(matname, svg)
+      sheets = self.data['materialsheets'].get(matname, []) + [svg]
+      self.update(matname, sheets, {len(sheets) - 1: version}, version)
+    self.notify()
+    return version
+
+  # Add a new sheet at the given position among the sheets of the given
+  # material. Returns the new version of the database
+  def insertSheet(self, matname, index, svg):
+    with self.lock:
+      self.refresh()
+      version = self.store.insertSheet(matname, index, svg)
+      sheets = list(self.data['materialsheets'].get(matname, []))
+      sheets.insert(index, svg)
+      self.update(matname, sheets, {sheetid: version for sheetid in range(index, len(sheets))}, version)
+    self.notify()
+    return version
+
+  # Replace the contents of the database with the given JSON database
+  def importJSON(self, filename):
+    with self.lock:
+      version = self.store.importJSON(filename)
+      self.data = None
+    self.notify()
+    return version
+
+  # Write the contents of the database out as a JSON database
+  def exportJSON(self, filename):
+    with open(filename, 'w') as outfile:
+      json.dump(self.load(), outfile)
+
+# The material database shared by all of Fabricaide
+materialdb = MaterialDB()
+
+if __name__ == "__main__":
+  argparser = argparse.ArgumentParser(description='Convert the material database to and from the JSON format')
+  argparser.add_argument('command', choices=['import', 'export'], help='Import from or export to the JSON file')
+  argparser.add_argument('jsonfile', nargs='?', default=MAT_DB_JSON, help='The JSON material database file')
+  argparser.add_argument('--db', dest='db', default=MAT_DB, help='The material database')
+  args = argparser.parse_args()
+
+  store = MaterialStore(args.db, args.jsonfile)
+  if args.command == 'import':
+    store.importJSON(args.jsonfile)
+  else:
+    store.exportJSON(args.jsonfile)
@@ -0,0 +1,200 @@
+# Optional memory tracking with tracemalloc
+#
+# When tracing is turned on, the memory allocated by Python is traced, so
+# that the peak and retained memory of each packing job and each of its
+# stages can be measured, and the largest allocation sites (and those that
+# have grown the most since tracing started) can be listed. Tracing slows
+# everything down, so it is off unless FABRICAIDE_TRACE_MEMORY is set (to
+# the number of frames to keep per allocation) or it is turned on through
+# the /memory endpoint.
+#
+# Peaks are measured for the whole process, so a stage that runs while
+# another thread allocates is charged for both.
+#
+# Every process of the service traces its own memory. When a state store is
+# attached, tracing is turned on and off for all processes together, and
+# each process publishes its report there after every packing job. The
+# reports of processes that have exited are dropped.
+#
+# Provides:
+#   MemoryTracker: measures and reports memory usage
+#   memorytracker: the MemoryTracker shared by all of Fabricaide
+
+import contextlib
+import linecache
+import os
+import threading
+import time
+import tracemalloc
+
+TRACE_FRAMES = int(os.environ.get('FABRICAIDE_TRACE_MEMORY', '0'))   # 0 leaves tracing off
+TOP_SITES = 20                  # Number of allocation sites in reports
+TRACING_KEY = 'memory.tracing'  # Number of frames traced by all processes, or 0
+REPORT_PREFIX = 'memory:'       # Reports in the state store are keyed by this and the process ID
+
+class MemoryTracker:
+  def __init__(self, frames=TRACE_FRAMES):
+    self.lock = threading.Lock()
+    self.state = None
+
+    # Measurements in progress. tracemalloc only keeps one peak, so the peak
+    # seen by each measurement is kept here whenever it is reset
+    self.open = []
+
+    # Snapshot taken when tracing started, to find the sites that have grown
+    self.baseline = None
+    self.started = None
+
+    # The memory usage of the most recent packing job
+    self.lastjob = None
+
+    if frames > 0:
+      self.start(frames)
+
+  # Turn tracing on and off for all processes through the given state store
+  def share(self, state):
+    self.state = state
+
+  # Start tracing, keeping the given number of frames per allocation
+  def start(self, frames=1):
+    with self.lock:
+      if tracemalloc.is_tracing():
+        return
+      tracemalloc.start(frames)
+      self.baseline = tracemalloc.take_snapshot()
+      self.started = time.time()
+      print('[Memory] Tracing memory allocations ({} frames)'.format(frames))
+
+  # Stop tracing
+  def stop(self):
+    with self.lock:
+      if not tracemalloc.is_tracing():
+        return
+      tracemalloc.stop()
+      self.open = []
+      self.baseline = None
+      self.started = None
+      print('[Memory] Stopped tracing memory allocations')
+
+  def tracing(self):
+    return tracemalloc.is_tracing()
+
+  # Turn tracing on or off in every process
+  def setTracing(self, frames):
+    if self.state is not None:
+      self.state.set(TRACING_KEY, frames)
+    self.sync(frames)
+
+  # Follow the tracing setting of the state store
+  def sync(self, frames=None):
+    if frames is None:
+      if self.state is None:
+        return
+      frames = self.state.get(TRACING_KEY, TRACE_FRAMES)
+    if frames > 0 and not self.tracing():
+      self.start(frames)
+    elif frames == 0 and self.tracing():
+      self.stop()
+
+  # Start measuring. Returns the measurement to pass to end(), or None if
+  # memory is not being traced
+  def begin(self):
+    if not self.tracing():
+      return None
+    with self.lock:
+      current, peak = tracemalloc.get_traced_memory()
+      for measurement in self.open:
+        measurement['peak'] = max(measurement['peak'], peak)
+      tracemalloc.reset_peak()
+      measurement = {'start': current, 'peak': current}
+      self.open.append(measurement)
+      return measurement
+
+  # Finish the given measurement. Returns the peak memory above what was
+  # allocated at the start, and the memory retained since then, in bytes
+  def end(self, measurement):
+    if measurement is None or not self.tracing():
+      return None
+    with self.lock:
+      current, peak = tracemalloc.get_traced_memory()
+      self.open = [other for other in self.open if other is not measurement]
+      for other in self.open:
+        other['peak'] = max(other['peak'], peak)
+      return {
+        'peak': max(measurement['peak'], peak) - measurement['start'],
+        'retained': current - measurement['start']
+      }
+
+  # Forget the given measurement without finishing it
+  def discard(self, measurement):
+    with self.lock:
+      self.open = [other for other in self.open if other is not measurement]
+
+  # Measure the body. The dict that is yielded is filled in with the
+  # result of end() (and stays empty if memory is not being traced)
+  @contextlib.contextmanager
+  def measure(self):
+    usage = {}
+    measurement = self.begin()
+    try:
+      yield usage
+    finally:
+      result = self.end(measurement)
+      if result is not None:
+        usage.update(result)
+
+  # Record the memory usage of a packing job and publish the report
+  def recordJob(self, usage):
+    self.lastjob = usage
+    self.publish()
+
+  # Return a report of the memory usage of this process
+  def report(self, top=TOP_SITES):
+    report = {'pid': os.getpid(), 'tracing': self.tracing(), 'lastjob': self.lastjob, 'time': time.time()}
+    if not self.tracing():
+      return report
+
+    current, _ = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+      tracemalloc.Filter(False, tracemalloc.__file__),
+      tracemalloc.Filter(False, linecache.__file__)
+    ])
+    report.update({
+      'since': self.started,
+      'current': current,
+      'traced_memory': tracemalloc.get_tracemalloc_memory(),
+      'top': [self.describe(stat.traceback, stat.size, stat.count) for stat in snapshot.statistics('lineno')[:top]],
+      'growth': [self.describe(stat.traceback, stat.size_diff, stat.count_diff)
+                 for stat in snapshot.compare_to(self.baseline, 'lineno')[:top] if stat.size_diff > 0]
+    })
+    return report
+
+  def describe(self, traceback, size, count):
+    frame = traceback[0]
+    return {
+      'site': '{}:{}'.format(frame.filename, frame.lineno),
+      'code': linecache.getline(frame.filename, frame.lineno).strip(),
+      'size': size,
+      'count': count
+    }
+
+  # Publish the report of this process to the state store
+  def publish(self):
+    if self.state is None:
+      return
+    try:
+      self.state.set(REPORT_PREFIX + str(os.getpid()), self.report())
+    except Exception as e:
+      print('[Memory] Could not publish the memory report: {}'.format(e))
+
+  # Return the reports of every process, with an up to date report of
+  # this process
+  def reports(self):
+    own = self.report()
+    if self.state is None:
+      return [own]
+    others = [report for key, report in self.state.processItems(REPORT_PREFIX) if report['pid'] != own['pid']]
+    return [own] + others
+
+# The memory tracker shared by all of Fabricaide
+memorytracker = MemoryTracker()
@@ -0,0 +1,175 @@
+# Performance metrics
+#
+# Records counters, gauges and histograms of durations (packing stages,
+# PNG renders, request latencies, ...) and renders them in the Prometheus
+# text format for the /metrics endpoint.
+#
+# Every process of the service records its own metrics. When a state store
+# is attached, each process regularly publishes a snapshot of its metrics
+# there, and the metrics of all processes are merged when rendered, so that
+# /metrics reports the packing done by the packer whichever process serves it.
+# The snapshots of processes that have exited are dropped.
+#
+# Provides:
+#   Metrics: a set of metrics
+#   metrics: the Metrics shared by all of Fabricaide
+
+import bisect
+import contextlib
+import json
+import os
+import threading
+import time
+
+import fabricade_state
+
+# Upper bounds in seconds of the buckets of duration histograms
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+PUBLISH_INTERVAL = 1.0        # Seconds between publishing snapshots to the state store
+SNAPSHOT_PREFIX = 'metrics:'  # Snapshots in the state store are keyed by this and the process ID
+
+# Known metrics, with their type and description
+DESCRIPTIONS = {
+  'fabricaide_stage_seconds': ('histogram', 'Time spent in each stage of packing'),
+  'fabricaide_packings_total': ('counter', 'Number of packing runs'),
+  'fabricaide_parts_total': ('counter', 'Number of parts loaded from designs'),
+  'fabricaide_packed_sheets_total': ('counter', 'Number of packed sheets written'),
+  'fabricaide_reused_materials_total': ('counter', 'Number of materials whose previous packing was reused'),
+  'fabricaide_failed_fits_total': ('counter', 'Number of parts that did not fit onto their material'),
+  'fabricaide_crashed_materials_total': ('counter', 'Number of materials whose packing crashed'),
+  'fabricaide_last_packing_parts': ('gauge', 'Number of parts in the most recent packing'),
+  'fabricaide_last_packing_seconds': ('gauge', 'Duration of the most recent packing'),
+  'fabricaide_preview_renders_total': ('counter', 'Number of PNG previews, by whether they were rendered or cached'),
+  'fabricaide_preview_render_seconds': ('histogram', 'Time spent rendering PNG previews with cairosvg'),
+  'fabricaide_request_seconds': ('histogram', 'Latency of the REST API, by endpoint'),
+}
+
+class Metrics:
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.counters = {}
+    self.gauges = {}
+    self.histograms = {}
+
+    self.state = None
+    self.published = 0
+
+  # Publish snapshots to the given state store from now on
+  def share(self, state):
+    self.state = state
+
+  # Add the given value to a counter
+  def increment(self, name, value=1, **labels):
+    with self.lock:
+      key = self.key(name, labels)
+      self.counters[key] = self.counters.get(key, 0) + value
+    self.publish()
+
+  # Set a gauge to the given value
+  def set(self, name, value, **labels):
+    with self.lock:
+      self.gauges[self.key(name, labels)] = (time.time(), value)
+    self.publish()
+
+  # Record a value (a duration in seconds) in a histogram
+  def observe(self, name, value, **labels):
+    with self.lock:
+      key = self.key(name, labels)
+      histogram = self.histograms.get(key)
+      if histogram is None:
+        histogram = self.histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+      histogram[bisect.bisect_left(BUCKETS, value)] += 1
+      histogram[-1] += value
+    self.publish()
+
+  # Record the duration of the body in a histogram
+  @contextlib.contextmanager
+  def time(self, name, **labels):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.observe(name, time.perf_counter() - start, **labels)
+
+  def key(self, name, labels):
+    return json.dumps([name, sorted(labels.items())])
+
+  # Return the metrics of this process in a form that can be stored as JSON
+  def snapshot(self):
+    with self.lock:
+      return {
+        'counters': dict(self.counters),
+        'gauges': dict(self.gauges),
+        'histograms': {key: list(histogram) for key, histogram in self.histograms.items()}
+      }
+
+  # Publish a snapshot to the state store, unless one was published recently
+  def publish(self, force=False):
+    if self.state is None or (not force and time.time() - self.published < PUBLISH_INTERVAL):
+      return
+    self.published = time.time()
+    try:
+      self.state.set(SNAPSHOT_PREFIX + str(os.getpid()), self.snapshot())
+    except Exception as e:
+      print('[Metrics] Could not publish metrics: {}'.format(e))
+
+  # Return the snapshots of every process, with the up to date metrics of
+  # this process
+  def snapshots(self):
+    if self.state is None:
+      return [self.snapshot()]
+    self.publish(force=True)
+    return [value for key, value in self.state.processItems(SNAPSHOT_PREFIX)]
+
+  # Render the metrics of every process in the Prometheus text format
+  def render(self):
+    counters = {}
+    gauges = {}
+    histograms = {}
+    for snapshot in self.snapshots():
+      for key, value in snapshot['counters'].items():
+        counters[key] = counters.get(key, 0) + value
+      for key, (updated, value) in snapshot['gauges'].items():
+        if key not in gauges or gauges[key][0] < updated:
+          gauges[key] = (updated, value)
+      for key, histogram in snapshot['histograms'].items():
+        total = histograms.setdefault(key, [0] * len(histogram))
+        for i, value in enumerate(histogram):
+          total[i] += value
+
+    # Group the series by metric
+    series = {}
+    for kind, values in [('counter', counters), ('gauge', gauges), ('histogram', histograms)]:
+      for key, value in values.items():
+        name, labels = json.loads(key)
+        series.setdefault(name, (kind, []))[1].append((labels, value))
+
+    lines = []
+    for name in sorted(series):
+      kind, values = series[name]
+      description = DESCRIPTIONS.get(name, (kind, name))[1]
+      lines.append('# HELP {} {}'.format(name, description))
+      lines.append('# TYPE {} {}'.format(name, kind))
+      for labels, value in sorted(values, key=lambda item: item[0]):
+        if kind == 'counter':
+          lines.append('{}{} {}'.format(name, formatLabels(labels), value))
+        elif kind == 'gauge':
+          lines.append('{}{} {}'.format(name, formatLabels(labels), value[1]))
+        else:
+          cumulative = 0
+          for bound, count in zip(BUCKETS + ['+Inf'], value[:-1]):
+            cumulative += count
+            lines.append('{}_bucket{} {}'.format(name, formatLabels(labels + [['le', str(bound)]]), cumulative))
+          lines.append('{}_sum{} {}'.format(name, formatLabels(labels), value[-1]))
+          lines.append('{}_count{} {}'.format(name, formatLabels(labels), cumulative))
+    return '\n'.join(lines) + '\n'
+
+# Format (name, value) label pairs for the Prometheus text format
+def formatLabels(labels):
+  if len(labels) == 0:
+    return ''
+  escaped = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in labels]
+  return '{' + ','.join(escaped) + '}'
+
+# The metrics shared by all of Fabricaide
+metrics = Metrics()
@@ -1,27 +1,42 @@
 # Processes packing jobs.
 #
 # Optimizes packing jobs by reusing the most recent packing for a particular
-# material if no modifications have been made to that material.
+# material if no modifications have been made to that material. Changes are
+# detected with fingerprints of the geometry of the parts, so reordering the
+# parts or re-exporting the design with different formatting does not count
+# as a modification. When only
+# some of the parts of a material have changed, the previous placements of
+# the unchanged parts are kept and only the new parts are packed around them.
+#
+# Copies of a design are not cloned into the DOM. Every part is kept once,
+# along with its multiplicity (the number of copies of it to pack), and is
+# only repeated when the input of the packer is serialized.
 
-import itertools
+import concurrent.futures
+import contextlib
+import hashlib
 import glob
 import packaide
 import json
+import math
+import multiprocessing
 import os
 import re
-import shapely.geometry
 import shutil
-import threading
 import time
 import traceback
 import xml.dom.minidom as DOM
 
-from cairosvg import svg2png
+import fabricade_geometry
+import fabricade_ingest
+import fabricade_matdb
+import fabricade_memory
+import fabricade_metrics
+import fabricade_previews
 
 USE_3D = False
 
 __MAT_DB_UI__ = 'FabricaideUI/data/matdb'
-__MAT_DB__ = 'mat-data.txt'
 __COLOR_DB__ = 'colordict2.json'
 __NO_FILL__ = 'fill:none'
 __CUT_STYLE__ = 'fill:none;stroke:red;stroke-miterlimit:10;stroke-width:0.0001px'
@@ -30,18 +45,94 @@ __COLOR_STYLE__ = '{};stroke:none'
 PACKED_PREVIEW_DIR = 'FabricaideUI/data/packed'
 PACKED_OUTPUT_DIR = 'cuts'
 
+# Attribute that tags every part with a hash of its geometry, so that its
+# placement can be recognised in the packer's output. The hash does not
+# depend on where the part is, so moving a part around the design keeps it
+PART_ATTR = 'data-fabricaide-part'
+
+# Attributes that describe the geometry of each kind of shape. Other shapes
+# are described by all of their attributes except the ones that are ignored
+GEOMETRY_ATTRS = {
+  'rect': ['x', 'y', 'width', 'height', 'rx', 'ry'],
+  'circle': ['cx', 'cy', 'r'],
+  'ellipse': ['cx', 'cy', 'rx', 'ry'],
+  'line': ['x1', 'y1', 'x2', 'y2'],
+  'polygon': ['points'],
+  'polyline': ['points'],
+  'path': ['d'],
+}
+IGNORED_ATTRS = ['id', 'class', 'style', 'data-name', PART_ATTR]
+
+# Attributes that only give the position of each kind of shape
+POSITION_ATTRS = {
+  'rect': ['x', 'y'],
+  'circle': ['cx', 'cy'],
+  'ellipse': ['cx', 'cy'],
+}
+
+# Numbers and commands in geometry attributes
+GEOMETRY_TOKEN = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?|[A-Za-z]')
+
+# Functions in transform attributes
+TRANSFORM_TOKEN = re.compile(r'([A-Za-z]+)\s*\(([^)]*)\)')
+
+# The parameters of each path command, where x and y are coordinates (absolute
+# for uppercase commands) and n is any other number
+PATH_PARAMETERS = {'M': 'xy', 'L': 'xy', 'T': 'xy', 'H': 'x', 'V': 'y', 'C': 'xyxyxy', 'S': 'xyxy', 'Q': 'xyxy', 'A': 'nnnnnxy', 'Z': ''}
+
+# Incremental packing falls back to a full repack once more than this share
+# of the free area of the sheets holding kept parts lies outside the largest
+# free region of its sheet, i.e. once the free space is too broken up for
+# new parts to be packed into it well
+FRAGMENTATION_REPACK_THRESHOLD = 0.5
+
+# Number of worker processes used to pack materials concurrently. A value
+# of 1 packs the materials one at a time in the packing thread
+PACKING_WORKERS = int(os.environ.get('FABRICAIDE_PACKING_WORKERS', '1'))
+
+# Pack the given shapes onto the given material sheets. This lives at module
+# level so that it can be sent to the worker processes of the packing pool
+def packShapes(svgsheetlist, shapes):
+  return packaide.pack(svgsheetlist, shapes, tolerance=5, offset=10, partial_solution=True, rotations=2)
+
 class PackingJob:
-  def __init__(self):
+  def __init__(self, workers=PACKING_WORKERS, outputdir=PACKED_OUTPUT_DIR, previewdir=PACKED_PREVIEW_DIR):
+    # Directories that the packed SVG files and their PNG previews are written to
+    self.outputdir = outputdir
+    self.previewdir = previewdir
+
     # Objects with colours not corresponding to any material in
     # the database will default to this material instead
     self.defaultmat = '0.1mm-white-letterpaper'
 
     # dictionary that associates a shape with its slots (3D only)
     self.slots = {}
+
+    # Worker processes for packing materials in parallel (created on demand)
+    self.workers = workers
+    self.pool = None
+
+    # Generation number of the most recently requested packing. A run that
+    # belongs to an older generation stops at the next material boundary
+    self.generation = 0
+
+    # Set by cancel(), after which every packing run stops like a superseded one
+    self.cancelled = False
   
     # Material availability and colour mappings  
-    with open(__MAT_DB__, 'r') as file:
-      self.materialsdb = json.load(file)
+    self.materialdb = fabricade_matdb.materialdb
+    self.materialsdb = self.materialdb.load()
+
+    # Parsed geometry of the material sheets, shared with the rest of Fabricaide
+    self.geometrycache = fabricade_geometry.geometrycache
+
+    # Consumed area of each sheet, keyed by (material, sheet ID, offset), along
+    # with the sheet version and the hash of the packed shapes it was computed for
+    self.consumedareas = {}
+
+    # PNG previews are rendered in the background by the shared preview service
+    self.previews = fabricade_previews.previewservice
+    self.previewjobs = []
     with open(__COLOR_DB__, 'r') as file:
       self.colorsdb = json.load(file)
 
@@ -51,93 +142,641 @@ class PackingJob:
     # Parts in the design file are split by material assignment
     self.materials = []
     self.materialcuts = {}
+    self.partcounts = {} # multiplicity of each part in materialcuts, in order
+    self.materialfingerprints = {}
     self.reuse_materials = []
     self.packingresults = {}
+    self.packingversions = {} # versions of the sheets of each material when it was last packed
   
     # Auxiliary data produced by packing
     self.insufficientmaterials = []
     self.crashedmaterials = []
     self.failed_fits = {} # number of failed fits per insufficient material
     self.percentages = {}
+    self.packedareas = {} # area of the sheets of each material taken up by its most recent packing
+
+    # Speculative packings of substitute materials (see planSubstitution()),
+    # keyed by material and the fingerprint of the parts that were packed
+    self.substitutepackings = {}
+
+    # Time spent in each stage of the most recent packing (see stage()), and
+    # counts of what it processed
+    self.metrics = fabricade_metrics.metrics
+    self.timings = {'stages': {}, 'materials': {}}
+    self.counts = {}
+
+    # Peak and retained memory of the most recent packing and its stages,
+    # when memory is being traced (see fabricade_memory)
+    self.memorytracker = fabricade_memory.memorytracker
+    self.memory = {'stages': {}}
+    self.jobmemory = None
   
   # Load an SVG file to prepare for a packing job
   def loadFile(self, filename, copies):
+    self.timings = {'stages': {}, 'materials': {}}
+    self.memory = {'stages': {}}
+    self.memorytracker.discard(self.jobmemory)
+    self.jobmemory = self.memorytracker.begin()
+    with self.stage('load'):
+      self.readFile(filename, copies)
+
+  # Body of loadFile()
+  def readFile(self, filename, copies):
     self.filename = filename
   
-    # Reload the material database incase something
-    # has changed (new holes added etc.)  
-    with open(__MAT_DB__, 'r') as file:
-      self.materialsdb = json.load(file)
+    # Pick up any changes to the material database
+    # (new holes added etc.)  
+    self.materialsdb = self.materialdb.load()
 
     # Design and material information
     if USE_3D: 
-      self.svginput = self.flattenSVGLayers3D(copies)
+      with self.stage('flatten'):
+        self.svginput = self.flattenSVGLayers3D()
+      with self.stage('split'):
+        new_materialcuts, new_partcounts = self.splitMaterials(copies)
     else:
-      self.svginput = self.flattenSVGLayers(copies)
-
-    new_materialcuts = self.splitMaterials()
+      with self.stage('ingest'):
+        new_materialcuts, new_partcounts = self.ingestDesign(copies)
     new_materials = list(new_materialcuts.keys())
     
-    # Re-use old packing if the parts for a material have not changed
+    # Re-use old packing if the parts for a material and its sheets have not changed
+    new_fingerprints = {material: self.materialFingerprint(cuts, new_partcounts[material]) for material, cuts in new_materialcuts.items()}
     self.reuse_materials = []
     for material in self.materials:
-      if material in new_materials:
-        if self.materialcuts[material].toxml() == new_materialcuts[material].toxml():
+      if material in new_materials and material in self.materialcuts:
+        if self.materialfingerprints.get(material) == new_fingerprints[material] and not self.sheetsChanged(material):
           self.reuse_materials.append(material)
     
     self.materials = new_materials
     self.materialcuts = new_materialcuts
+    self.partcounts = new_partcounts
+    self.materialfingerprints = new_fingerprints
   
   # Returns true if n copies of the given SVG file can fit onto the
-  # currently available materials
+  # currently available materials. This is a dry run (see dryRun()), so
+  # the loaded design and the packed files are left untouched
   def canFitNCopies(self, filename, copies):
-    self.loadFile(filename, copies)
-    self.doPacking()
-    return len(self.insufficientmaterials) == 0
+    materialcuts, partcounts = self.readParts(filename)
+    fits, _ = self.dryRun(materialcuts, partcounts, copies)
+    return fits
   
   # Compute the maximum number of copies of the contents of the given
-  # SVG files that can fit onto the currently available materials
+  # SVG files that can fit onto the currently available materials. This is
+  # the smallest of the maximum numbers of copies of the parts of each
+  # material, so every material is searched separately, with probes that are
+  # dry runs of one material (see dryRun()). The design and the material
+  # database are only read once.
+  #
+  # The searches of all materials run together, keeping every packing worker
+  # busy: each free worker takes a probe of a material that is not done
+  # yet, splitting the largest interval of numbers of copies that has not
+  # been probed. Each search starts below an upper bound estimated from the
+  # areas of the sheets and the parts (see copiesBound()), and stops once it
+  # reaches the smallest number of copies that did not fit any material
   def computeMaxCopies(self, filename):
-    lo = 0
-    hi = 1
-    while (self.canFitNCopies(filename, hi)):
-      hi *= 2
-    while lo < hi - 1:
-      mid = lo + (hi - lo) // 2
-      if (self.canFitNCopies(filename, mid)):
-        lo = mid
-      else:
-        hi = mid
-    return lo
-  
-  # Run the packing asynchronously
-  def packAsync(self):
-    # Initiate packing in a new thread
-    self.packingJob = threading.Thread(target=lambda : self.doPacking())
-    self.packingJob.start()
+    materialcuts, partcounts = self.readParts(filename)
+    return self.maxCopies(materialcuts, partcounts)
+
+  # Body of computeMaxCopies(), for parts that have already been read (see
+  # readParts()). The search is abandoned as soon as cancelled() returns
+  # True, in which case None is returned. Probes run on the given executor
+  # if there is one, the given number at a time, and otherwise on worker
+  # processes of their own, so that the search neither competes with a
+  # packing for the packing pool nor goes down with it when a worker dies
+  def maxCopies(self, materialcuts, partcounts, cancelled=None, executor=None, slots=1):
+    materialsdb = self.materialdb.load()
+    if len(materialcuts) == 0:
+      return 0
+
+    # lo copies are known to fit, hi copies are known not to (None if unknown)
+    searches = {}
+    for material in materialcuts:
+      bound = self.copiesBound(material, materialcuts[material], partcounts[material], materialsdb)
+      searches[material] = {'lo': 0, 'hi': None if bound is None else bound + 1, 'probes': set()}
+
+    # With a single worker, probes run one at a time in a helper thread
+    helper = None
+    if executor is None and self.workers > 1:
+      executor = helper = self.makePool()
+      slots = self.workers
+    elif executor is None:
+      executor = helper = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+      slots = 1
+
+    pending = {}
+    try:
+      with self.metrics.time('fabricaide_stage_seconds', stage='max_copies'):
+        while True:
+          if cancelled is not None and cancelled():
+            return None
+          cap = min([search['hi'] for search in searches.values() if search['hi'] is not None], default=None)
+          if all(self.searchDone(search, cap) for search in searches.values()):
+            break
+          for material, copies in self.nextProbes(searches, cap, slots - len(pending)):
+            counts = [count * copies for count in partcounts[material]]
+            future = executor.submit(packShapes, materialsdb['materialsheets'][material], self.packerInput(materialcuts[material], counts))
+            pending[future] = (material, copies)
+            searches[material]['probes'].add(copies)
+          # Wake up now and then to check for cancellation
+          timeout = None if cancelled is None else 0.1
+          done, _ = concurrent.futures.wait(pending, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+          for future in done:
+            material, copies = pending.pop(future)
+            search = searches[material]
+            search['probes'].discard(copies)
+            try:
+              fits = future.result()[2] == 0
+            except Exception as e:
+              # The executor is shut down when the search is cancelled
+              if cancelled is not None and cancelled():
+                return None
+              # A material that cannot be packed counts as not fitting
+              print('[Packing] Dry run of {} crashed: {}'.format(material, e))
+              fits = False
+            if fits:
+              search['lo'] = max(search['lo'], copies)
+            elif search['hi'] is None or copies < search['hi']:
+              search['hi'] = copies
+    finally:
+      for future in pending:
+        future.cancel()
+      if helper is not None:
+        helper.shutdown(wait=False, cancel_futures=True)
+
+    return min(search['lo'] for search in searches.values())
+
+  # Choose up to the given number of probes of the searches of
+  # computeMaxCopies(), taking turns between the materials. Numbers of copies
+  # of cap or more are known not to fit some material. Returns a list of
+  # (material, copies) pairs
+  def nextProbes(self, searches, cap, slots):
+    probes = []
+    chosen = True
+    while len(probes) < slots and chosen:
+      chosen = False
+      for material, search in searches.items():
+        if len(probes) == slots:
+          break
+        copies = self.nextProbe(search, cap)
+        if copies is not None:
+          probes.append((material, copies))
+          search['probes'].add(copies)
+          chosen = True
+    for material, copies in probes:
+      searches[material]['probes'].discard(copies)
+    return probes
+
+  # Return the next number of copies to probe in the given search, or None
+  # if no more probes are needed. Without an upper bound the number of
+  # copies doubles, otherwise the largest interval left is halved
+  def nextProbe(self, search, cap):
+    hi = self.searchLimit(search, cap)
+    points = sorted(copies for copies in search['probes'] if copies > search['lo'] and (hi is None or copies < hi))
+    if hi is None:
+      return max([search['lo']] + points) * 2 or 1
+
+    points = [search['lo']] + points + [hi]
+    gap, start = max((end - start, start) for start, end in zip(points, points[1:]))
+    if gap <= 1:
+      return None
+    return start + gap // 2
+
+  # Return the smallest number of copies that the given search of
+  # computeMaxCopies() does not have to probe (None if there is no limit yet)
+  def searchLimit(self, search, cap):
+    if search['hi'] is None or (cap is not None and cap < search['hi']):
+      return cap
+    return search['hi']
+
+  # Return True if the given search of computeMaxCopies() has found how many
+  # copies fit, as far as the overall answer is concerned
+  def searchDone(self, search, cap):
+    hi = self.searchLimit(search, cap)
+    return hi is not None and search['lo'] >= hi - 1
+
+  # Return an upper bound on the number of copies of the given parts of a
+  # material that can fit onto its sheets: the area of the sheets that has
+  # not been cut out yet, divided by the area of one copy of the parts.
+  # Returns None if the area of the parts cannot be measured
+  def copiesBound(self, material, materialcuts, counts, materialsdb):
+    try:
+      _, polygons = packaide.extract_shapely_polygons(self.packerInput(materialcuts, counts), 0)
+      partarea = sum(polygon.area - sum(hole.area for hole in holes) for polygon, holes in polygons)
+      freearea = 0
+      for sheetid in range(len(materialsdb['materialsheets'][material])):
+        geometry = self.geometrycache.get(material, sheetid, 0)
+        freearea += geometry.width * geometry.height - geometry.consumedArea()
+    except Exception as e:
+      print('[Packing] Could not estimate the copies of {} that fit: {}'.format(material, e))
+      return None
+    if partarea <= 0:
+      return None
+    return int(freearea / partarea)
+
+  # Read the parts of the given SVG file, one copy of each, without loading
+  # it as the design to pack. Returns the parts of each material and their
+  # multiplicities, as splitMaterials() does
+  def readParts(self, filename):
+    if USE_3D:
+      # The slots of FlatFab designs are only separated from their shapes
+      # when the DOM is flattened, so the design is flattened as usual, but
+      # with slots of its own
+      svginput = self.flattenSVGLayers3D(filename, {})
+      return self.splitMaterials(svginput=svginput)
+    _, materialcuts, partcounts = self.readDesign(filename, 1)
+    return materialcuts, partcounts
+
+  # Pack the given parts, with their multiplicities multiplied by the given
+  # number of copies, only to find out whether they fit. Nothing is written
+  # or rendered, no sheet percentages are computed and the state of the
+  # loaded design is left alone. Packing stops at the first material that
+  # does not fit. Returns whether all parts fit, and the number of failed
+  # fits of the material that did not, or None if cancelled() returned True.
+  # Materials are packed on the given executor if there is one, in which
+  # case the dry run stops as soon as it is cancelled, and otherwise in the
+  # current thread, in which case it only stops between two materials
+  def dryRun(self, materialcuts, partcounts, copies, materialsdb=None, cancelled=None, executor=None):
+    if materialsdb is None:
+      materialsdb = self.materialdb.load()
+
+    with self.metrics.time('fabricaide_stage_seconds', stage='dry_run'):
+      for material in materialcuts:
+        if cancelled is not None and cancelled():
+          return None
+        counts = [count * copies for count in partcounts[material]]
+        if sum(counts) == 0:
+          continue
+        args = (materialsdb['materialsheets'][material], self.packerInput(materialcuts[material], counts))
+        try:
+          if executor is None:
+            result = packShapes(*args)
+          else:
+            result = self.awaitProbe(executor.submit(packShapes, *args), cancelled)
+            if result is None:
+              return None
+          num_failed_fits = result[2]
+        except Exception as e:
+          # The executor is shut down when the dry run is cancelled
+          if cancelled is not None and cancelled():
+            return None
+          # A material that cannot be packed counts as not fitting at all
+          print('[Packing] Dry run of {} crashed: {}'.format(material, e))
+          num_failed_fits = sum(counts)
+        if num_failed_fits > 0:
+          return False, {material: num_failed_fits}
+    return True, {}
   
-  # Return True if the most recent asynchronous packing job has finished
-  def packingIsDone(self):
-    return not self.packingJob.is_alive()
-
-  # Return the available area for a given material as a percentage
+  # Wait for the given packing future and return its result, or None if
+  # cancelled() returns True first
+  def awaitProbe(self, future, cancelled=None):
+    while True:
+      done, _ = concurrent.futures.wait([future], timeout=None if cancelled is None else 0.1)
+      if len(done) > 0:
+        return future.result()
+      if cancelled():
+        future.cancel()
+        return None
+
+  # Return True if the given packing generation has been superseded or
+  # the packing has been cancelled
+  def isStale(self, generation):
+    return self.cancelled or (generation is not None and generation != self.generation)
+
+  # Stop packing at the next material boundary, for good
+  def cancel(self):
+    self.cancelled = True
+
+  # Stop a superseded packing run before the given material. The materials
+  # that were not packed are forgotten so that the next run repacks them
+  # rather than reusing their out-of-date packings
+  def abandonPacking(self, generation, material, pending):
+    print('[Packing] Abandoning packing generation {} since it has been {}'.format(generation, 'cancelled' if self.cancelled else 'superseded'))
+    for future in pending.values():
+      future.cancel()
+    for remaining in self.materials[self.materials.index(material):]:
+      self.materialcuts.pop(remaining, None)
+      self.partcounts.pop(remaining, None)
+
+  # Remove the PNG previews of the previous packing
+  def clearPreviews(self):
+    if os.path.exists(self.previewdir):
+      shutil.rmtree(self.previewdir)
+    os.makedirs(self.previewdir)
+
+  # Return the results of the most recent packing
+  def results(self):
+    return {
+      'usage': self.percentages,
+      'insufficient': self.insufficientmaterials,
+      'crashed': self.crashedmaterials,
+      'failed_fits': self.failed_fits,
+      'packed_area': {material: self.packedareas.get(material, 0) for material in self.materials},
+      'timings': self.timings,
+      'counts': self.counts,
+      'memory': self.memory
+    }
+
+  # Time the body as the given stage of packing, optionally of a single
+  # material. The durations of the stages of the most recent packing add up
+  # in self.timings, and every duration is recorded in the metrics. Stages
+  # may be nested: load includes ingest, and pack includes merge
+  @contextlib.contextmanager
+  def stage(self, name, material=None):
+    start = time.perf_counter()
+    try:
+      with self.memorytracker.measure() as usage:
+        yield
+    finally:
+      if usage:
+        stages = self.memory['stages']
+        previous = stages.get(name, {'peak': 0, 'retained': 0})
+        stages[name] = {'peak': max(previous['peak'], usage['peak']), 'retained': previous['retained'] + usage['retained']}
+      elapsed = time.perf_counter() - start
+      stages = self.timings['stages']
+      stages[name] = stages.get(name, 0) + elapsed
+      if material is not None:
+        stages = self.timings['materials'].setdefault(material, {})
+        stages[name] = stages.get(name, 0) + elapsed
+      self.metrics.observe('fabricaide_stage_seconds', elapsed, stage=name)
+
+  # Return the available area for a given material as a percentage. Only
+  # the sheets whose packed file has changed since the last call are measured
+  # again (see consumedArea())
   def calculateSupplyLevels(self, material):
-    svgsheetlist = self.materialsdb['materialsheets'][material]
     packedfiles = []
-    for idx,packedfile in enumerate(sorted(glob.glob(PACKED_OUTPUT_DIR+"/*.svg"))):
+    for idx,packedfile in enumerate(sorted(glob.glob(os.path.join(self.outputdir, glob.escape(material) + '_*.svg')))):
       packedfile = os.path.basename(packedfile)
       matname, matid = packedfile[:-4].split('_')
       if matname == material:
-        with open(os.path.join(PACKED_OUTPUT_DIR,packedfile) , 'r') as packedshapes:
+        with open(os.path.join(self.outputdir,packedfile) , 'r') as packedshapes:
           packedfiles.append((0, packedshapes.read()))
 
-    merged_sheets = self.merge_sheets(svgsheetlist, packedfiles)
-    self.percentages[material] = self.sheet_percentage(merged_sheets)
+    self.percentages[material] = self.sheet_percentage(material, packedfiles)
     return self.percentages[material]
   
   def reset_cache(self):
     self.materialcuts = {}
+    self.partcounts = {}
+    self.materialfingerprints = {}
     self.materials = []
+    self.packingresults = {}
+    self.packingversions = {}
+    self.packedareas = {}
+    self.consumedareas = {}
+
+  # Return the current versions of the sheets of the given material
+  def sheetVersionsOf(self, material):
+    sheetversions = self.materialdb.sheetVersions()
+    return [sheetversions.get((material, sheetid)) for sheetid in range(len(self.materialdb.load()['materialsheets'].get(material, [])))]
+
+  # Returns true if the sheets of the given material have changed since it
+  # was last packed (holes cut out, sheets added or removed), in which case
+  # none of its previous placements can be trusted
+  def sheetsChanged(self, material):
+    return self.packingversions.get(material) != self.sheetVersionsOf(material)
+
+  # Return the pool of packing worker processes, starting it if necessary.
+  # The workers are started from a fork server rather than forked from this
+  # process, since by now it runs other threads (the web server, the packer,
+  # the preview pool) whose locks a forked child could inherit while held
+  def getPool(self):
+    if self.pool is None:
+      self.pool = self.makePool()
+    return self.pool
+
+  # Start a new pool of packing worker processes (see getPool())
+  def makePool(self):
+    return concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('forkserver'))
+
+  # Stop the packing worker processes. A new pool is started by the next
+  # parallel packing run
+  def shutdownPool(self):
+    if self.pool is not None:
+      self.pool.shutdown(wait=False)
+      self.pool = None
+
+  # Work out how the given material should be packed. Returns a tuple of the
+  # sheets and the shapes to give to the packer, and a map from sheet IDs to
+  # the previously packed parts that keep their placements (None for a full
+  # repack). The shapes are None if there is nothing new to pack
+  def planPacking(self, material):
+    svgsheetlist = self.materialdb.load()['materialsheets'][material]
+    fullplan = (svgsheetlist, self.packerInput(self.materialcuts[material], self.partcounts[material]), None)
+
+    # (3D only) the slots are re-attached to the packed parts afterwards
+    if USE_3D or material not in self.packingresults or self.sheetsChanged(material):
+      return fullplan
+
+    try:
+      placements = self.previousPlacements(material)
+      kept = {}
+      numkept = 0
+      topack = self.makeMaterialSheet()
+      topackcounts = []
+      for part, count in zip(self.partsOf(self.materialcuts[material]), self.partcounts[material]):
+        previous = placements.get(part.getAttribute(PART_ATTR), [])
+        numplaced = min(count, len(previous))
+        for copy in range(numplaced):
+          sheetid, element = previous.pop()
+          kept.setdefault(sheetid, []).append(element)
+        numkept += numplaced
+        if count > numplaced:
+          topack.appendChild(part.cloneNode(False))
+          topackcounts.append(count - numplaced)
+
+      # Parts that were removed leave gaps behind, and new parts have to be
+      # squeezed in around the old ones, so once the free space is too
+      # broken up the whole material is better packed again
+      numnew = sum(topackcounts)
+      if numkept == 0 or (numnew > 0 and self.fragmentation(material, kept) > FRAGMENTATION_REPACK_THRESHOLD):
+        return fullplan
+
+      print('[Packing] Keeping {} placed parts for {} and packing {} new parts'.format(numkept, material, numnew))
+      sheets = [self.addPlacedParts(sheet, kept.get(sheetid, [])) for sheetid, sheet in enumerate(svgsheetlist)]
+      shapes = self.packerInput(topack, topackcounts) if numnew > 0 else None
+      return (sheets, shapes, kept)
+
+    # The previous packing could not be read back, so start from scratch
+    except Exception:
+      traceback.print_exc()
+      return fullplan
+
+  # Return how broken up the free space is that is left around the given
+  # kept placements of the given material: the share of the free area of the
+  # sheets holding them that lies outside the largest free region of its sheet
+  def fragmentation(self, material, kept):
+    freearea = 0
+    largest = 0
+    for sheetid, elements in kept.items():
+      root = DOM.parseString(self.materialdb.getSheet(material, sheetid)).getElementsByTagName('svg')[0]
+      for child in [child for child in root.childNodes]:
+        root.removeChild(child)
+      for element in elements:
+        root.appendChild(element.cloneNode(True))
+      geometry = self.geometrycache.get(material, sheetid, fabricade_geometry.OFFSET)
+      areas = [region.area for region in geometry.freeRegions(self.packedPolygons(root.toxml(), fabricade_geometry.OFFSET))]
+      freearea += sum(areas)
+      largest += max(areas, default=0)
+    if freearea == 0:
+      return 0
+    return 1 - largest / freearea
+
+  # Return the parts of the given material that were not placed by its most
+  # recent packing, and their multiplicities
+  def overflowParts(self, material):
+    placements = self.previousPlacements(material)
+    overflow = self.makeMaterialSheet()
+    counts = []
+    for part, count in zip(self.partsOf(self.materialcuts[material]), self.partcounts[material]):
+      previous = placements.get(part.getAttribute(PART_ATTR), [])
+      numplaced = min(count, len(previous))
+      del previous[:numplaced]
+      if count > numplaced:
+        overflow.appendChild(part.cloneNode(False))
+        counts.append(count - numplaced)
+    return overflow, counts
+
+  # Plan packing the parts of the given material that did not fit onto the
+  # given substitute material, together with the parts of the design that
+  # are already made of the substitute. This is what the substitute would
+  # have to hold if the parts that did not fit were switched over to it.
+  # Returns the sheets and the shapes to give to the packer, the versions
+  # of the sheets and the fingerprint of the parts, or None if there is
+  # nothing to pack or the substitute has no sheets
+  def planSubstitution(self, material, substitute):
+    svgsheetlist = self.materialdb.load()['materialsheets'].get(substitute, [])
+    overflow, counts = self.overflowParts(material)
+    if len(svgsheetlist) == 0 or len(counts) == 0:
+      return None
+
+    # Switched parts take on the colour of the substitute (see makePart())
+    for part in self.partsOf(overflow):
+      part.setAttribute('style', __COLOR_STYLE__.format(self.colorsdb[substitute]))
+    if substitute in self.materialcuts:
+      for part, count in zip(self.partsOf(self.materialcuts[substitute]), self.partcounts[substitute]):
+        overflow.appendChild(part.cloneNode(False))
+        counts.append(count)
+
+    sheetversions = self.sheetVersionsOf(substitute)
+    fingerprint = json.dumps(self.materialFingerprint(overflow, counts))
+    return svgsheetlist, self.packerInput(overflow, counts), sheetversions, fingerprint
+
+  # Keep the result of packing a plan made by planSubstitution(), so that
+  # the substitute does not have to be packed again if the design comes to
+  # have exactly those parts of it
+  def addSubstitutePacking(self, substitute, sheetversions, fingerprint, result):
+    packings = dict(self.substitutepackings.get(substitute, {}))
+    packings[fingerprint] = (sheetversions, result)
+    self.substitutepackings[substitute] = packings
+
+  # Forget the speculative packings of substitute materials
+  def clearSubstitutePackings(self):
+    self.substitutepackings = {}
+
+  # Return the speculative packing of the given material for its current
+  # parts, or None if there is none or its sheets have changed since
+  def substitutePacking(self, material):
+    packing = self.substitutepackings.get(material, {}).get(json.dumps(self.materialfingerprints[material]))
+    if packing is None:
+      return None
+    sheetversions, result = packing
+    if sheetversions != self.sheetVersionsOf(material):
+      return None
+    return result
+
+  # Return a map from part fingerprints to the list of (sheet ID, element)
+  # placements of those parts in the most recent packing of the given material.
+  # The packed files are read back from disk when available since the user
+  # may have manually edited the packing
+  def previousPlacements(self, material):
+    placements = {}
+    for sheetid, shapes in self.packingresults[material]:
+      packedfile = os.path.join(self.outputdir, '{}_{}.svg'.format(material, sheetid))
+      if os.path.exists(packedfile):
+        doc = DOM.parse(packedfile)
+      else:
+        doc = DOM.parseString(shapes)
+      for element in doc.getElementsByTagName('svg')[0].childNodes:
+        if element.nodeType == element.TEXT_NODE:
+          continue
+        fingerprint = self.getPartAttr(element)
+        if fingerprint:
+          placements.setdefault(fingerprint, []).append((sheetid, element))
+    return placements
+
+  # Return the fingerprint of a packed element. The packer may wrap a part
+  # in a group, in which case the fingerprint is found on its descendants
+  def getPartAttr(self, element):
+    if element.hasAttribute(PART_ATTR):
+      return element.getAttribute(PART_ATTR)
+    for child in element.childNodes:
+      if child.nodeType == child.ELEMENT_NODE:
+        fingerprint = self.getPartAttr(child)
+        if fingerprint:
+          return fingerprint
+    return None
+
+  # Return the given sheet with the given placed parts added to it as holes
+  def addPlacedParts(self, sheet, elements):
+    if len(elements) == 0:
+      return sheet
+    doc = DOM.parseString(sheet)
+    root = doc.getElementsByTagName('svg')[0]
+    for element in elements:
+      root.appendChild(element.cloneNode(True))
+    return root.toxml()
+
+  # Combine the kept placements of an incremental packing with the newly
+  # packed parts, producing the same kind of result as a full packing
+  def mergePlacedParts(self, material, kept, result):
+    packed, success_fits, num_failed_fits = result
+    newlypacked = dict(packed)
+    merged = []
+    for sheetid in sorted(set(kept) | set(newlypacked)):
+      if sheetid in newlypacked:
+        root = DOM.parseString(newlypacked[sheetid]).getElementsByTagName('svg')[0]
+      else:
+        root = DOM.parseString(self.materialdb.getSheet(material, sheetid)).getElementsByTagName('svg')[0]
+        for child in [child for child in root.childNodes]:
+          root.removeChild(child)
+      for element in kept.get(sheetid, []):
+        root.appendChild(element.cloneNode(True))
+      merged.append((sheetid, root.toxml()))
+    return merged, success_fits + sum(len(elements) for elements in kept.values()), num_failed_fits
+
+  # Send the given packing plans to the worker pool to be packed concurrently.
+  # Returns a map from materials to the futures of their packing results,
+  # which is empty if the packing should instead run serially
+  def submitPacking(self, plans):
+    plans = {material: plan for material, plan in plans.items() if plan[1] is not None}
+    if self.workers <= 1 or len(plans) <= 1:
+      return {}
+
+    pool = self.getPool()
+    return {material: pool.submit(packShapes, sheets, shapes) for material, (sheets, shapes, _) in plans.items()}
+
+  # Return the packing result of the given material, either by waiting for
+  # the worker that is packing it or by packing it in the current thread
+  def collectPacking(self, material, plan, pending):
+    sheets, shapes, kept = plan
+    if material in pending:
+      result = pending[material].result()
+    elif shapes is not None:
+      result = packShapes(sheets, shapes)
+    else:
+      result = ([], 0, 0)
+
+    if kept is None:
+      return result
+
+    # The new parts did not all fit around the old ones, but they might
+    # still fit if the whole material is packed again
+    if result[2] > 0:
+      print('[Packing] Incremental packing of {} failed, repacking all parts'.format(material))
+      return packShapes(self.materialdb.load()['materialsheets'][material], self.packerInput(self.materialcuts[material], self.partcounts[material]))
+
+    with self.stage('merge', material):
+      return self.mergePlacedParts(material, kept, result)
 
   # Take the output of the packing, and the input sheets, and produce a sequence of
   # documents that contains the original sheets with holes with the newly packed
@@ -155,35 +794,68 @@ class PackingJob:
       sheets.append(doc)
     return sheets
 
-  #SVG files should ideally be file names
-  def sheet_percentage(self, svg_files, offset = 20):
+  # Return the fraction of the total area of the sheets of the given material
+  # that is consumed by their holes and the given packing output, followed by
+  # the fraction consumed of each sheet. As in merge_sheets(), the packed
+  # shapes are paired with the sheets in order. The holes of each sheet come
+  # from the geometry cache, so only the packed shapes need to be processed
+  def sheet_percentage(self, material, packing_output, offset = fabricade_geometry.OFFSET):
     consumed_area = 0
     total_area = 0
     sheet_consumption= []
-    for svg_file in svg_files:
-      svg_string = svg_file.toxml()
-      height, width = packaide.get_sheet_dimensions(svg_string)
-      boundary = shapely.geometry.Polygon([(0,0),(width,0),(height,width),(0, height)])
-      total_area += boundary.area
-      elements, shapely_polygons = packaide.extract_shapely_polygons(svg_string, offset)
-      if len(shapely_polygons) > 0:
-        polygons, holes_list = zip(*shapely_polygons)
-        union = shapely.ops.unary_union(polygons)
-        holes = list(itertools.chain(*holes_list))
-        hole_union = shapely.ops.unary_union(holes)
-        unbounded_consume = union.difference(hole_union)
-        consumed = boundary.intersection(unbounded_consume)
-        consumed_area += consumed.area
-        sheet_consumption.append(consumed.area/ boundary.area)
-      else:
-        consumed_area += 0
-        sheet_consumption.append(0)
+    for sheetid in range(len(self.materialdb.load()['materialsheets'][material])):
+      geometry = self.geometrycache.get(material, sheetid, offset)
+      packed = packing_output[sheetid][1] if sheetid < len(packing_output) else None
+      consumed = self.consumedArea(material, sheetid, packed, offset)
+      total_area += geometry.boundary.area
+      consumed_area += consumed
+      sheet_consumption.append(consumed / geometry.boundary.area)
     return [consumed_area/total_area] + sheet_consumption
 
+  # Return the area of the sheets of the given material that the given
+  # packing output takes up, on top of their holes
+  def packedArea(self, material, packing_output, offset = fabricade_geometry.OFFSET):
+    area = 0
+    for sheetid, packed in packing_output:
+      geometry = self.geometrycache.get(material, sheetid, offset)
+      area += self.consumedArea(material, sheetid, packed, offset) - geometry.consumedArea()
+    return area
+
+  # Return the area of the given sheet that is consumed by its holes and the
+  # given packed SVG string (None if nothing is packed onto it). The result is
+  # cached until the sheet or the content of the packed shapes changes
+  def consumedArea(self, material, sheetid, packed, offset):
+    key = (material, sheetid, offset)
+    version = self.materialdb.sheetVersion(material, sheetid)
+    digest = hashlib.sha1(packed.encode('utf-8')).hexdigest() if packed is not None else None
+    cached = self.consumedareas.get(key)
+    if cached is not None and cached[0] == version and cached[1] == digest:
+      return cached[2]
+
+    packed_polygons = self.packedPolygons(packed, offset) if packed is not None else []
+    consumed = self.geometrycache.get(material, sheetid, offset).consumedArea(packed_polygons)
+    self.consumedareas[key] = (version, digest, consumed)
+    return consumed
+
+  # Return the (polygon, holes) pairs of the shapes in the given packed SVG
+  # string. Like merge_sheets(), this only considers groups and paths
+  def packedPolygons(self, packed, offset):
+    doc = DOM.parseString(packed)
+    svgElement = doc.getElementsByTagName('svg')[0]
+    for element in [element for element in svgElement.childNodes]:
+      if element.nodeType != element.ELEMENT_NODE or not (element.tagName == 'g' or element.tagName == 'path'):
+        svgElement.removeChild(element)
+    if not svgElement.hasChildNodes():
+      return []
+    _, shapely_polygons = packaide.extract_shapely_polygons(svgElement.toxml(), offset)
+    return shapely_polygons
+
   # Run the packing procedure for all materials. This should usually
   # be called from a new thread to avoid blocking the caller, since
-  # packing could take a while... See packAsync().
-  def doPacking(self):
+  # packing could take a while... See fabricade_worker. If a generation is given,
+  # the run stops early once a newer generation has been requested. Either
+  # way, it stops early once the packing is cancelled (see cancel()).
+  def doPacking(self, generation=None):
     self.packingSuccess = True
     self.missingMaterials = []
     self.packedFiles = []
@@ -191,59 +863,89 @@ class PackingJob:
     self.insufficientmaterials = []
     old_crashes = self.crashedmaterials
     self.crashedmaterials = []
+    self.previewjobs = []
+    start = time.perf_counter()
+    numsheets = 0
+
+    # Start packing every changed material on the worker pool up front. The
+    # results are collected below in material order, so the outcome is the
+    # same as for a serial run
+    with self.stage('plan'):
+      # The versions are taken before the sheets are read, so a sheet that is
+      # written in the meantime is seen as changed by the next packing
+      sheetversions = {material: self.sheetVersionsOf(material) for material in self.materials if material not in self.reuse_materials}
+      prepacked = {}
+      for material in self.materials:
+        if material not in self.reuse_materials:
+          result = self.substitutePacking(material)
+          if result is not None:
+            prepacked[material] = result
+      plans = {material: self.planPacking(material) for material in self.materials if material not in self.reuse_materials and material not in prepacked}
+      pending = self.submitPacking(plans)
 
     for material in self.materials:
-      shapestopack = self.materialcuts[material]
-      svgsheetlist = self.materialsdb['materialsheets'][material]
-      
-      if material in self.reuse_materials:
-        # Reuse the previous packing -- NOTE: We reload the packed SVG file from disk rather
-        # than reusing the stored file since the user may have manually editting the packing,
-        # and we would like to keep it if this is the case
-        print('[Packing] Reusing previous packing for {} since it has not changed'.format(material))
+      if self.isStale(generation):
+        self.abandonPacking(generation, material, pending)
+        self.metrics.increment('fabricaide_packings_total', outcome='abandoned')
+        self.memorytracker.discard(self.jobmemory)
+        self.jobmemory = None
+        return
+
+      # A material that fails only takes its own packing down with it
+      try:
+        if material in self.reuse_materials:
+          # Reuse the previous packing -- NOTE: We reload the packed SVG file from disk rather
+          # than reusing the stored file since the user may have manually editting the packing,
+          # and we would like to keep it if this is the case
+          print('[Packing] Reusing previous packing for {} since it has not changed'.format(material))
         
-        if material in old_crashes:
-          self.crashedmaterials.append(material)
-          continue
+          if material in old_crashes:
+            self.crashedmaterials.append(material)
+            continue
 
-        # This happens when the packing failed last time and the design has not changed
-        if material in old_insufficients:
-          self.insufficientmaterials.append(material)
+          # This happens when the packing failed last time and the design has not changed
+          if material in old_insufficients:
+            self.insufficientmaterials.append(material)
 
-          for sheetid, shapes in self.packingresults[material]:
-            # Output packed SVG files
-            svg_output = os.path.join(PACKED_OUTPUT_DIR, '{}_{}.svg'.format(material, sheetid))
+            for sheetid, shapes in self.packingresults[material]:
+              # Output packed SVG files
+              svg_output = os.path.join(self.outputdir, '{}_{}.svg'.format(material, sheetid))
 
-            with open(svg_output, 'w') as cutfile:
-              cutfile.write(shapes.toxml())
+              with open(svg_output, 'w') as cutfile:
+                cutfile.write(shapes)
 
-            # Generate PNG preview
-            self.generatePNGPreview(svg_output, material, sheetid)
+              # Generate PNG preview
+              self.generatePNGPreview(svg_output, material, sheetid)
             
-          continue
+            continue
 
-        for sheetid, _ in self.packingresults[material]:
-          svg_output = os.path.join(PACKED_OUTPUT_DIR, '{}_{}.svg'.format(material, sheetid))
-          self.generatePNGPreview(svg_output, material, sheetid)
+          for sheetid, _ in self.packingresults[material]:
+            svg_output = os.path.join(self.outputdir, '{}_{}.svg'.format(material, sheetid))
+            self.generatePNGPreview(svg_output, material, sheetid)
           
-      else: 
-        try: 
+        else: 
+          # The packing is made for the sheets as they were when it was planned
+          self.packingversions[material] = sheetversions[material]
           # Execute the packing algorithm
           print('[Packing] Running the packing algorithm on {}'.format(material))
           
-          start = time.time()
-          self.packingresults[material], success_fits, num_failed_fits = packaide.pack(svgsheetlist, shapestopack.toxml(), tolerance=5, offset=10, partial_solution=True, rotations=2)
+          with self.stage('pack', material):
+            if material in prepacked:
+              print('[Packing] Using the speculative packing of {}'.format(material))
+              self.packingresults[material], success_fits, num_failed_fits = prepacked[material]
+            else:
+              self.packingresults[material], success_fits, num_failed_fits = self.collectPacking(material, plans[material], pending)
 
           if num_failed_fits > 0:
             self.failed_fits[material] = num_failed_fits
             self.insufficientmaterials.append(material)
 
-          start = time.time()
-          merged_sheets = self.merge_sheets(svgsheetlist, self.packingresults[material])
-          self.percentages[material] = self.sheet_percentage(merged_sheets)
+          with self.stage('percentage', material):
+            self.percentages[material] = self.sheet_percentage(material, self.packingresults[material])
+            self.packedareas[material] = self.packedArea(material, self.packingresults[material])
           
           # remove old packed files for this material
-          old_packed_files = glob.glob(PACKED_OUTPUT_DIR + '/' + material+"*.svg")
+          old_packed_files = glob.glob(self.outputdir + '/' + material+"*.svg")
           for old_file in old_packed_files:
             os.remove(old_file)
 
@@ -254,25 +956,61 @@ class PackingJob:
           # Output each packed sheet
           for sheetid, shapes in self.packingresults[material]:
             # Output packed SVG files
-            svg_output = os.path.join(PACKED_OUTPUT_DIR, '{}_{}.svg'.format(material, sheetid))
+            svg_output = os.path.join(self.outputdir, '{}_{}.svg'.format(material, sheetid))
 
-            with open(svg_output, 'w') as cutfile:
-              cutfile.write(shapes)
+            with self.stage('svg_write', material):
+              with open(svg_output, 'w') as cutfile:
+                cutfile.write(shapes)
 
             # Generate PNG preview
-            start = time.time()
             self.generatePNGPreview(svg_output, material, sheetid)
-            print('gen PNG: ' + str(time.time()-start))
-            
-        # Failure indicates that something bad happened
-        except Exception as e:
-          self.packingSuccess = False
-          self.crashedmaterials.append(material)
-          if material in self.packingresults:
-            del self.packingresults[material]
+          numsheets += len(self.packingresults[material])
             
-          traceback.print_exc()
-          print('Packing routine failed')
+      # Failure indicates that something bad happened
+      except Exception as e:
+        self.packingSuccess = False
+        self.crashedmaterials.append(material)
+        if material in self.insufficientmaterials:
+          self.insufficientmaterials.remove(material)
+        if material in self.packingresults:
+          del self.packingresults[material]
+        self.packedareas.pop(material, None)
+
+        # A worker that died takes the whole pool down with it
+        if isinstance(e, concurrent.futures.BrokenExecutor):
+          self.shutdownPool()
+          
+        traceback.print_exc()
+        print('Packing routine failed')
+
+    # The packing is only done once its previews are ready
+    with self.stage('png_render'):
+      self.previews.wait(self.previewjobs)
+
+    elapsed = time.perf_counter() - start
+    self.timings['total'] = elapsed
+    self.counts = {
+      'parts': sum(sum(counts) for counts in self.partcounts.values()),
+      'materials': len(self.materials),
+      'reused_materials': len(self.reuse_materials),
+      'packed_sheets': numsheets,
+      'failed_fits': sum(self.failed_fits.get(material, 0) for material in self.insufficientmaterials),
+      'crashed_materials': len(self.crashedmaterials)
+    }
+    self.metrics.increment('fabricaide_packings_total', outcome='done')
+    self.metrics.increment('fabricaide_parts_total', self.counts['parts'])
+    self.metrics.increment('fabricaide_packed_sheets_total', numsheets)
+    self.metrics.increment('fabricaide_reused_materials_total', self.counts['reused_materials'])
+    self.metrics.increment('fabricaide_failed_fits_total', self.counts['failed_fits'])
+    self.metrics.increment('fabricaide_crashed_materials_total', self.counts['crashed_materials'])
+    self.metrics.set('fabricaide_last_packing_parts', self.counts['parts'])
+    self.metrics.set('fabricaide_last_packing_seconds', elapsed)
+
+    usage = self.memorytracker.end(self.jobmemory)
+    self.jobmemory = None
+    if usage is not None:
+      self.memory['job'] = usage
+      self.memorytracker.recordJob(self.memory)
   
   def placeSlots(self, material):
     sheetlist = self.packingresults[material]
@@ -296,24 +1034,26 @@ class PackingJob:
     self.packingresults[material] = newpackingresults
 
   # Generate the PNG preview of the packed shapes in the given SVG file. The preview
-  # contains the packed shapes as well as the existing holes on the given material sheet
+  # contains the packed shapes as well as the existing holes on the given material sheet.
+  # The preview is rendered in the background; doPacking() waits for it to finish
   def generatePNGPreview(self, svgfile, material, sheetid):
     # PNG previews should show the holes and the newly packed shapes
-    shapes = DOM.parse(svgfile)
-    root = shapes.getElementsByTagName('svg')[0]
-    children = [child for child in root.childNodes]
-    outdom = DOM.parseString(self.materialsdb['materialsheets'][material][sheetid])
-    outsvg = outdom.getElementsByTagName('svg')[0]
-    for child in children:
-      outsvg.appendChild(child)
+    with self.stage('png_prepare', material):
+      shapes = DOM.parse(svgfile)
+      root = shapes.getElementsByTagName('svg')[0]
+      children = [child for child in root.childNodes]
+      outsvg = self.geometrycache.get(material, sheetid).root.cloneNode(True)
+      for child in children:
+        outsvg.appendChild(child)
+      svg = outsvg.toxml() if len(children) > 0 else None
 
     # Create packed PNG preview files
-    if len(children) > 0:
-      pngout = os.path.join(PACKED_PREVIEW_DIR, '{}_{}.png'.format(material, sheetid))
-      svg2png(bytestring=outsvg.toxml(), write_to=pngout)
+    if svg is not None:
+      pngout = os.path.join(self.previewdir, '{}_{}.png'.format(material, sheetid))
+      self.previewjobs.append(self.previews.renderAsync(svg, pngout))
   
   # flattens layers in SVG file and removes title tag
-  def flattenSVGLayers(self, copies):
+  def flattenSVGLayers(self):
     doc = DOM.parse(self.filename)
     svgroot = doc.getElementsByTagName('svg')[0]
 
@@ -338,16 +1078,17 @@ class PackingJob:
     for child in children:
       if child.nodeType == child.TEXT_NODE:
         svgroot.removeChild(child)
-
-      else:
-        for copy in range(copies-1):
-          svgroot.appendChild(child.cloneNode(True))
     
     return svgroot
     
-  # flattens layers in SVG file exported from flatfab/kyub
-  def flattenSVGLayers3D(self, copies):
-    doc = DOM.parse(self.filename)
+  # flattens layers in SVG file exported from flatfab/kyub. The loaded
+  # design and its slots are used unless a file and slots are given
+  def flattenSVGLayers3D(self, filename=None, slots=None):
+    if filename is None:
+      filename = self.filename
+    if slots is None:
+      slots = self.slots
+    doc = DOM.parse(filename)
     svgroot = doc.getElementsByTagName('svg')[0]
 
     titles = svgroot.getElementsByTagName('title')
@@ -371,23 +1112,19 @@ class PackingJob:
             # assumption: the non-slot part of the shape should come 
             # before the slots in the SVG file...
             slotparentID = childID
-            self.slots[slotparentID] = []
+            slots[slotparentID] = []
           else:
             # should be list in case shape has multiple slots
-            self.slots[slotparentID].append(child) 
+            slots[slotparentID].append(child) 
 
       svgroot.removeChild(layer)
 
     children = [child for child in svgroot.childNodes]
 
-    # make copies
+    # copies are carried as multiplicities (see splitMaterials())
     for child in children:
       if child.nodeType == child.TEXT_NODE:
         svgroot.removeChild(child)
-
-      else:
-        for copy in range(copies-1):
-          svgroot.appendChild(child.cloneNode(True))
     
     return svgroot
 
@@ -432,25 +1169,205 @@ class PackingJob:
 
     return shape
   
+  # Return a hash of the geometry of the given part: its kind of shape, its
+  # geometry attributes and its transform. Numbers are normalized, so the
+  # hash does not depend on the order of the attributes or on formatting,
+  # and the position of the part is left out (see relativeGeometry()), so
+  # that it does not change when the part is moved. Shapes that are not
+  # listed in GEOMETRY_ATTRS are described by all of their attributes
+  def partFingerprint(self, shape):
+    if shape.tagName in GEOMETRY_ATTRS:
+      names = GEOMETRY_ATTRS[shape.tagName]
+    else:
+      names = [name for name in shape.attributes.keys() if name not in IGNORED_ATTRS]
+
+    canonical = [shape.tagName]
+    for name in sorted(names):
+      if shape.hasAttribute(name) and name not in POSITION_ATTRS.get(shape.tagName, []):
+        value = shape.getAttribute(name)
+        if shape.tagName in GEOMETRY_ATTRS:
+          value = self.relativeGeometry(shape, name, value)
+        canonical.append('{}={}'.format(name, self.normalizeGeometry(value)))
+    if shape.tagName in GEOMETRY_ATTRS:
+      canonical.append('transform={}'.format(self.normalizeGeometry(' '.join(map(str, self.linearTransform(shape.getAttribute('transform')))))))
+    return hashlib.sha1(';'.join(canonical).encode('utf-8')).hexdigest()[:16]
+
+  # Return the given value of a geometry attribute of the given shape, with
+  # its coordinates taken relative to the first point of the shape
+  def relativeGeometry(self, shape, name, value):
+    if shape.tagName == 'line':
+      start = {'x2': 'x1', 'y2': 'y1'}.get(name, name)
+      return ' '.join(str(number - origin) for number, origin in zip(self.geometryNumbers(value), self.geometryNumbers(shape.getAttribute(start)) or [0]))
+    if shape.tagName in ['polygon', 'polyline']:
+      numbers = self.geometryNumbers(value)
+      return ' '.join(str(number - numbers[i % 2]) for i, number in enumerate(numbers))
+    if shape.tagName == 'path':
+      return self.relativePath(value)
+    return value
+
+  # Return the given path data with its absolute coordinates taken relative
+  # to the start of the path. Relative coordinates are left as they are,
+  # except for the first point, which is always absolute
+  def relativePath(self, value):
+    tokens = []
+    origin = None
+    command = None
+    parameter = 0
+    for token in GEOMETRY_TOKEN.findall(value):
+      if token.isalpha():
+        # Closing a path is the same whichever case is used
+        tokens.append('Z' if token == 'z' else token)
+        command = token
+        parameter = 0
+        continue
+      number = float(token)
+      kinds = PATH_PARAMETERS.get(command.upper(), '') if command is not None else ''
+      kind = kinds[parameter % len(kinds)] if len(kinds) > 0 else 'n'
+      parameter += 1
+      if origin is None or len(origin) < 2:
+        origin = (origin or []) + [number]
+        number = 0.0
+      elif kind != 'n' and command.isupper():
+        number -= origin[0] if kind == 'x' else origin[1]
+      tokens.append(str(number))
+    return ' '.join(tokens)
+
+  # Return the a, b, c and d entries of the matrix of the given transform
+  # attribute, leaving out the translation
+  def linearTransform(self, value):
+    a, b, c, d = 1.0, 0.0, 0.0, 1.0
+    for function, arguments in TRANSFORM_TOKEN.findall(value):
+      numbers = self.geometryNumbers(arguments)
+      if function == 'matrix' and len(numbers) == 6:
+        m = numbers[:4]
+      elif function == 'scale' and len(numbers) > 0:
+        m = [numbers[0], 0, 0, numbers[1] if len(numbers) > 1 else numbers[0]]
+      elif function == 'rotate' and len(numbers) > 0:
+        angle = math.radians(numbers[0])
+        m = [math.cos(angle), math.sin(angle), -math.sin(angle), math.cos(angle)]
+      elif function == 'skewX' and len(numbers) > 0:
+        m = [1, 0, math.tan(math.radians(numbers[0])), 1]
+      elif function == 'skewY' and len(numbers) > 0:
+        m = [1, math.tan(math.radians(numbers[0])), 0, 1]
+      else:
+        continue
+      a, b, c, d = a * m[0] + c * m[1], b * m[0] + d * m[1], a * m[2] + c * m[3], b * m[2] + d * m[3]
+    return a, b, c, d
+
+  # Return the numbers in the given geometry attribute value
+  def geometryNumbers(self, value):
+    return [float(token) for token in GEOMETRY_TOKEN.findall(value) if not token.isalpha()]
+
+  # Return the given geometry attribute value with its numbers rounded and
+  # written in a standard way, separated by single spaces
+  def normalizeGeometry(self, value):
+    tokens = []
+    for token in GEOMETRY_TOKEN.findall(value):
+      if token.isalpha():
+        tokens.append(token)
+      else:
+        number = '{:.3f}'.format(float(token)).rstrip('0').rstrip('.')
+        tokens.append('0' if number == '-0' else number)
+    return ' '.join(tokens)
+
+  # Return the fingerprint of the parts of a material with the given
+  # multiplicities, which is the multiset of the fingerprints of its parts
+  def materialFingerprint(self, materialcuts, counts):
+    totals = {}
+    for part, count in zip(self.partsOf(materialcuts), counts):
+      fingerprint = part.getAttribute(PART_ATTR)
+      totals[fingerprint] = totals.get(fingerprint, 0) + count
+    return sorted(totals.items())
+
+  # Return a fingerprint of the given parts of a design and their
+  # multiplicities (see readParts()), which only changes when what would be
+  # packed changes
+  def designFingerprint(self, materialcuts, partcounts):
+    fingerprints = sorted([material, self.materialFingerprint(cuts, partcounts[material])] for material, cuts in materialcuts.items())
+    return hashlib.sha1(json.dumps(fingerprints).encode('utf-8')).hexdigest()
+
+  # Return the parts of the given material sheet
+  def partsOf(self, materialcuts):
+    return [part for part in materialcuts.childNodes if part.nodeType == part.ELEMENT_NODE]
+
+  # Serialize the given material sheet for the packer, repeating every part
+  # as many times as its multiplicity. Each part is only serialized once, and
+  # the copies follow the originals of all parts, as they did when copies
+  # were cloned into the design
+  def packerInput(self, materialcuts, counts):
+    parts = [part.toxml() for part in self.partsOf(materialcuts)]
+    copies = [part * (count - 1) for part, count in zip(parts, counts)]
+    # An element without children serializes as <tag .../>
+    root = materialcuts.cloneNode(False).toxml()
+    return '{}>{}{}</{}>'.format(root[:-2], ''.join(parts), ''.join(copies), materialcuts.tagName)
+
+  # Prepare the given shape to be packed as a part made of the given
+  # material, and return the part
+  def makePart(self, shape, matname):
+    shape = self.addMissingAttr(shape)
+    color = self.colorsdb[matname]
+    shape.setAttribute('style', __COLOR_STYLE__.format(color))
+    shape.setAttribute(PART_ATTR, self.partFingerprint(shape))
+    return shape.cloneNode(False)
+
   # Split the loaded SVG file up so that the different parts are
-  # associated with their corresponding material
-  def splitMaterials(self):
+  # associated with their corresponding material. Returns the parts of
+  # each material, and the multiplicity of each part (the given number of
+  # copies). The given flattened design is split instead if there is one
+  def splitMaterials(self, copies=1, svginput=None):
+    if svginput is None:
+      svginput = self.svginput
     materialcuts = {}
+    partcounts = {}
 
-    for shape in self.svginput.childNodes:
+    for shape in svginput.childNodes:
       if shape.nodeType != shape.TEXT_NODE:
         matname = self.getMaterialName(shape)
         if matname == None:
           continue
 
         if matname not in materialcuts:
-          materialcuts[matname] = self.makeMaterialSheet()
+          materialcuts[matname] = svginput.cloneNode(False)
+          partcounts[matname] = []
 
-        shape = self.addMissingAttr(shape)
-        color = self.colorsdb[matname]
-        shape.setAttribute('style', __COLOR_STYLE__.format(color))
+        materialcuts[matname].appendChild(self.makePart(shape, matname))
+        partcounts[matname].append(copies)
 
-        materialcuts[matname].appendChild(shape.cloneNode(False))
+    return materialcuts, partcounts
 
-    return materialcuts
+  # Read the design file and split its parts up by material in a single pass.
+  # This produces the same parts as flattenSVGLayers() followed by
+  # splitMaterials(), but without building and rearranging a DOM of the whole
+  # design, and each distinct shape is only classified once
+  def ingestDesign(self, copies):
+    self.svginput, materialcuts, partcounts = self.readDesign(self.filename, copies)
+    return materialcuts, partcounts
+
+  # Body of ingestDesign(), which returns the root element of the design
+  # along with its parts instead of loading it
+  def readDesign(self, filename, copies):
+    rootattrs, shapes = fabricade_ingest.readDesign(filename)
+    doc = DOM.Document()
+    svginput = fabricade_ingest.makeElement(doc, 'svg', rootattrs)
+
+    materialcuts = {}
+    partcounts = {}
+    stylematerials = {}
+    for tag, attrs in shapes:
+      shape = fabricade_ingest.makeElement(doc, tag, attrs)
+      style = shape.getAttribute('style')
+      if style not in stylematerials:
+        stylematerials[style] = self.getMaterialName(shape)
+      matname = stylematerials[style]
+      if matname == None:
+        continue
+
+      if matname not in materialcuts:
+        materialcuts[matname] = svginput.cloneNode(False)
+        partcounts[matname] = []
+
+      materialcuts[matname].appendChild(self.makePart(shape, matname))
+      partcounts[matname].append(copies)
+
+    return svginput, materialcuts, partcounts
     
@@ -0,0 +1,133 @@
+# Renders PNG previews of SVG documents
+#
+# Rendering with cairosvg is slow, and the same document is often rendered
+# over and over (e.g. the previews of reused packings are regenerated by
+# every packing run). Rendered PNGs are therefore kept in a cache directory
+# named by the hash of the SVG document, and a document that has been
+# rendered before is just copied from the cache. Documents that are not in
+# the cache are rendered on a bounded pool of worker threads. The cache is
+# limited in total size, evicting the least recently used PNGs first.
+#
+# Provides:
+#   PreviewService: renders (or reuses) PNG previews
+#   previewservice: the PreviewService shared by all of Fabricaide
+
+import concurrent.futures
+import hashlib
+import os
+import shutil
+import threading
+import traceback
+
+from cairosvg import svg2png
+
+import fabricade_metrics
+
+PREVIEW_CACHE_DIR = 'previewcache'          # Cached PNG renders
+PREVIEW_CACHE_SIZE = 256 * 1024 * 1024      # Maximum total size of the cache in bytes
+RENDER_WORKERS = 4                          # Number of previews rendered at once
+
+class PreviewService:
+  def __init__(self, cachedir=PREVIEW_CACHE_DIR, maxsize=PREVIEW_CACHE_SIZE, workers=RENDER_WORKERS):
+    self.cachedir = cachedir
+    self.maxsize = maxsize
+    self.workers = workers
+    self.pool = None
+    self.lock = threading.Lock()
+
+    # Total size of the cache, measured on first use
+    self.cachesize = None
+
+  # Return the pool of render threads, starting it if necessary
+  def getPool(self):
+    with self.lock:
+      if self.pool is None:
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+      return self.pool
+
+  # Return the cache file for the given SVG document
+  def cachePath(self, svg):
+    if isinstance(svg, str):
+      svg = svg.encode('utf-8')
+    return os.path.join(self.cachedir, hashlib.sha1(svg).hexdigest() + '.png')
+
+  # Render the given SVG document (a string or bytes) to the given PNG
+  # file, reusing a previous render of the same document if there is one.
+  # Returns True if the document actually had to be rendered
+  def render(self, svg, pngout):
+    cached = self.cachePath(svg)
+    rendered = False
+    try:
+      # Touch the cached render so that it counts as recently used
+      os.utime(cached)
+    except OSError:
+      with fabricade_metrics.metrics.time('fabricaide_preview_render_seconds'):
+        self.store(svg, cached)
+      rendered = True
+    shutil.copyfile(cached, pngout)
+    fabricade_metrics.metrics.increment('fabricaide_preview_renders_total', result='rendered' if rendered else 'cached')
+    return rendered
+
+  # Render the given SVG document in the background. Returns a future
+  # whose result is the same as that of render()
+  def renderAsync(self, svg, pngout):
+    return self.getPool().submit(self.render, svg, pngout)
+
+  # Wait for the given renders to finish, reporting any that failed.
+  # Returns True if they all succeeded
+  def wait(self, futures):
+    success = True
+    for future in futures:
+      try:
+        future.result()
+      except Exception:
+        success = False
+        traceback.print_exc()
+        print('Rendering a preview failed')
+    return success
+
+  # Render the given SVG document into the cache
+  def store(self, svg, cached):
+    os.makedirs(self.cachedir, exist_ok=True)
+
+    # Render to a temporary file first so that a half-written PNG is never
+    # mistaken for a finished one
+    partial = '{}.{}.part'.format(cached, threading.get_ident())
+    svg2png(bytestring=svg, write_to=partial)
+    os.replace(partial, cached)
+
+    with self.lock:
+      if self.cachesize is None:
+        self.cachesize = self.measure()
+      else:
+        self.cachesize += os.path.getsize(cached)
+      if self.cachesize > self.maxsize:
+        self.evict()
+
+  # Return the total size of the cache
+  def measure(self):
+    return sum(os.path.getsize(os.path.join(self.cachedir, name)) for name in os.listdir(self.cachedir) if name.endswith('.png'))
+
+  # Remove the least recently used renders until the cache fits within its
+  # maximum size, leaving some room to grow. Must hold the lock
+  def evict(self):
+    entries = []
+    for name in os.listdir(self.cachedir):
+      if name.endswith('.png'):
+        stat = os.stat(os.path.join(self.cachedir, name))
+        entries.append((stat.st_mtime, stat.st_size, name))
+    entries.sort()
+
+    self.cachesize = sum(size for _, size, _ in entries)
+    target = self.maxsize * 3 // 4
+    for _, size, name in entries:
+      if self.cachesize <= target:
+        break
+      try:
+        os.remove(os.path.join(self.cachedir, name))
+        self.cachesize -= size
+      except OSError:
+        pass
+
+# The preview renderer shared by all of Fabricaide
+previewservice = PreviewService()
@@ -0,0 +1,130 @@
+# On-demand CPU profiling
+#
+# Profiles a block of code (e.g. one packing run) and writes the profile to
+# the profiles directory, where it can be fetched over HTTP. The sampling
+# profiler pyinstrument is used when it is installed, producing an HTML
+# report, a text report and a collapsed stack file (for flame graph tools).
+# Otherwise the profile is taken with cProfile, producing a pstats file and
+# a text report of the functions with the highest cumulative time.
+#
+# Only the thread that runs the block is profiled, so packing that is done
+# by the worker processes of the packing pool shows up as waiting.
+#
+# Provides:
+#   Profiler: profiles blocks of code into a directory
+#   profiler: the Profiler shared by all of Fabricaide
+
+import contextlib
+import cProfile
+import io
+import os
+import pstats
+import re
+import threading
+import time
+
+try:
+  import pyinstrument
+except ImportError:
+  pyinstrument = None
+
+PROFILES_DIR = 'profiles'
+SAMPLING_INTERVAL = 0.001     # Seconds between samples of the sampling profiler
+REPORT_LINES = 60             # Number of functions listed in cProfile text reports
+
+class Profiler:
+  def __init__(self, directory=PROFILES_DIR):
+    self.directory = directory
+    self.lock = threading.Lock()
+
+  # Profile the body, writing the profile to files whose names start with
+  # the given name and a timestamp. The names of the files written are
+  # appended to the list that is yielded. Only one profile is taken at a
+  # time, so the body runs without profiling if another one is in progress
+  @contextlib.contextmanager
+  def profile(self, name):
+    if not self.lock.acquire(blocking=False):
+      print('[Profiler] Not profiling {} since another profile is in progress'.format(name))
+      yield []
+      return
+    try:
+      with self.profiling(name) as files:
+        yield files
+    finally:
+      self.lock.release()
+
+  # Body of profile()
+  @contextlib.contextmanager
+  def profiling(self, name):
+    os.makedirs(self.directory, exist_ok=True)
+    prefix = '{}-{}'.format(time.strftime('%Y%m%d-%H%M%S'), re.sub(r'[^A-Za-z0-9_.-]', '_', name))
+    files = []
+
+    if pyinstrument is not None:
+      profiler = pyinstrument.Profiler(interval=SAMPLING_INTERVAL)
+      profiler.start()
+      try:
+        yield files
+      finally:
+        profiler.stop()
+        files.extend(self.writeSampled(prefix, profiler))
+    else:
+      profiler = cProfile.Profile()
+      profiler.enable()
+      try:
+        yield files
+      finally:
+        profiler.disable()
+        files.extend(self.writeTraced(prefix, profiler))
+    print('[Profiler] Wrote profile {}'.format(', '.join(files)))
+
+  # Write the profile taken by pyinstrument
+  def writeSampled(self, prefix, profiler):
+    files = [prefix + '.html', prefix + '.txt', prefix + '.collapsed']
+    self.write(files[0], profiler.output_html())
+    self.write(files[1], profiler.output_text(unicode=False, color=False))
+
+    stacks = []
+    root = profiler.last_session.root_frame() if profiler.last_session is not None else None
+    if root is not None:
+      self.collapse(root, [], stacks)
+    self.write(files[2], ''.join('{} {}\n'.format(';'.join(stack), weight) for stack, weight in stacks))
+    return files
+
+  # Add the collapsed stacks of the given frame and its descendants to the
+  # list, weighted by their self time in microseconds
+  def collapse(self, frame, stack, stacks):
+    stack = stack + ['{} ({}:{})'.format(frame.function, frame.file_path_short, frame.line_no)]
+    selftime = frame.time - sum(child.time for child in frame.children)
+    weight = int(round(selftime * 1e6))
+    if weight > 0:
+      stacks.append((stack, weight))
+    for child in frame.children:
+      self.collapse(child, stack, stacks)
+
+  # Write the profile taken by cProfile
+  def writeTraced(self, prefix, profiler):
+    files = [prefix + '.pstats', prefix + '.txt']
+    profiler.dump_stats(os.path.join(self.directory, files[0]))
+    report = io.StringIO()
+    stats = pstats.Stats(profiler, stream=report)
+    stats.sort_stats('cumulative').print_stats(REPORT_LINES)
+    self.write(files[1], report.getvalue())
+    return files
+
+  def write(self, filename, content):
+    with open(os.path.join(self.directory, filename), 'w') as outfile:
+      outfile.write(content)
+
+  # Return the names, sizes and modification times of the profiles, newest first
+  def profiles(self):
+    if not os.path.exists(self.directory):
+      return []
+    profiles = []
+    for filename in os.listdir(self.directory):
+      stat = os.stat(os.path.join(self.directory, filename))
+      profiles.append({'name': filename, 'size': stat.st_size, 'modified': stat.st_mtime})
+    return sorted(profiles, key=lambda profile: profile['modified'], reverse=True)
+
+# The profiler shared by all of Fabricaide
+profiler = Profiler()
@@ -4,8 +4,33 @@
 #
 # Process the given SVG document and create the packed outputs
 #   /process?svgfile=<svg file name>
-# Check whether a process job has completed and new data is available
-#   /check_refresh
+# Watch the given SVG document and process it whenever it changes
+#   /watch?svgfile=<svg file name>&copies=<number of copies>
+# Stop watching the SVG document
+#   /unwatch
+# Submit a design to the packing job queue
+#   /jobs/submit?svgfile=<svg file name>&copies=<number of copies>&user=<user name>&priority=<priority>
+# Return the status of all jobs, or of one job (including its results once done)
+#   /jobs
+#   /jobs/<job id>
+# Cancel a job
+#   /jobs/<job id>/cancel
+# Check whether a process job has completed and new data is available,
+# optionally waiting for it to complete
+#   /check_refresh[?wait=<seconds>]
+# Return performance metrics in the Prometheus text format
+#   /metrics
+# Profile the next packing run, list the profiles taken, or download one
+#   /profile_next_packing
+#   /profiles
+#   /profiles/<file name>
+# Compute the maximum number of copies of a design that fit, or check
+# whether a number of copies fits (answered from the speculation cache
+# when possible)
+#   /maxcopies?svgfile=<svg file name>
+#   /fits?svgfile=<svg file name>&copies=<number of copies>
+# Report memory usage, optionally turning memory tracing on or off
+#   /memory[?trace=<number of frames, or 0 to turn tracing off>]
 # Execute the given laser cutter job:
 #   /lasercut?jobfile=<job file>&matname=<material name>
 # Check whether the laser cutter job has finished
@@ -14,6 +39,8 @@
 #   /update_material_database?jobfile=<job file>&matname=<material name>&sheetid=<ID of sheet>
 # Generate the thumbnails for the material database
 #   /generate_thumbnails
+# Generate the thumbnails for the given sheets of the material database
+#   /generate_sheet_thumbnails?sheets=<material>_<sheet id>,...
 # Open the given file
 #   /open_file?svgfile=<svg file name>
 # Return a list of similar materials for a given material
@@ -22,8 +49,16 @@
 #   /shutdown
 #
 # See individual functions for more information.
+#
+# State that must outlive a request lives in the shared state store rather
+# than in this module, so the service can run in several processes at once,
+# e.g. under gunicorn:
+#   gunicorn -w 4 -b 127.0.0.1:3000 fabricade_service:app
+# Packing is done in the background by whichever process holds the packer
+# lease (see fabricade_worker). While it is idle, it packs the shapes that
+# did not fit onto substitute materials and precomputes the copies of the
+# packed design that fit (see fabricade_speculation).
 
-from cairosvg import svg2png, svg2pdf
 # from RemoteLaserCutter.Client.remote_laser import RemoteLaserCutter
 
 import argparse
@@ -37,11 +72,22 @@ import time
 import intellipack
 import xml.dom.minidom as DOM
 
+import fabricade_jobs
+import fabricade_matdb
+import fabricade_memory
+import fabricade_metrics
+import fabricade_previews
+import fabricade_profiler
+import fabricade_speculation
+import fabricade_state
+import fabricade_substitutes
 import fabricade_svgutils
 import fabricade_packing
+import fabricade_watcher
+import fabricade_worker
 import fabricaide_contours
 
-from flask import Flask, flash, request, redirect, url_for, session, send_file
+from flask import Flask, flash, request, redirect, url_for, session, send_file, send_from_directory, g
 
 # Directories
 PACKED_PREVIEW_DIR = 'FabricaideUI/data/packed/'
@@ -49,7 +95,8 @@ PACKED_OUTPUT_DIR = 'cuts/'
 EXPORTED_FILES_DIR = 'fabricaide_files/'
 PLACEHOLDER_FILES_DIR = 'FabricaideUI/data/placeholder/'
 
-MAT_DB = 'mat-data.txt'   # Material availability data
+REFRESH_WAIT_LIMIT = 30   # Longest time in seconds that /check_refresh may wait
+
 
 # Configure the service as a webserver hosting a REST API
 app = Flask(__name__)
@@ -57,8 +104,23 @@ args = None
 
 # Persistent data needed across multiple requests
 remoteLaser = None                                  # Remove laser cutting interface
-currentlyPacking = False                            # True if a job is being packed
-packingProcess = fabricade_packing.PackingJob()     # The packing procedure (runs asynchronously)
+materialdb = fabricade_matdb.materialdb             # Material availability data
+state = fabricade_state.StateStore()                # State shared by all processes of the service
+packingProcess = fabricade_packing.PackingJob()     # The packing procedure (runs in the packer)
+packer = fabricade_worker.Packer(packingProcess, state) # Packs requested designs in the background
+designWatcher = None                                # Watches the design file in watch mode (in the packer)
+watchedDesign = None                                # File and copies that designWatcher watches
+scheduler = fabricade_jobs.Scheduler(state, packer) # Queued packing jobs (the packer runs the default job)
+packer.addTask(scheduler.dispatch)
+fabricade_metrics.metrics.share(state)
+fabricade_memory.memorytracker.share(state)
+packer.addTask(fabricade_memory.memorytracker.sync)
+speculator = fabricade_speculation.Speculator(packingProcess, state, packer) # Speculative work while the packer is idle
+packer.addTask(speculator.dispatch)
+packer.addTask(fabricade_substitutes.substituteindex.update) # Keeps up with other processes' writes
+
+REGISTRATION_KEY = 'registration_material'          # Material of the sheet being registered
+WATCH_KEY = 'watch'                                 # File and copies to watch, or None
 
 UPLOAD_FORM = """
   <form class="addmaterial" action="/register" name="registerform-MATNAME" id="registerform-MATNAME" method="post" enctype="multipart/form-data">
@@ -128,63 +190,265 @@ REGISTER_PAGE = """
 """
 
 # Process the given SVG file and create the packed
-# output of all of the shapes that it contains
+# output of all of the shapes that it contains. If a
+# previous design is still being packed, that packing
+# is abandoned at its next material boundary
 #
 # args:
 #  svgfile: The filename of the SVG file
 #  copies: The number of copies that should be packed
+#  profile (optional): If true, the packing run is profiled
+#    and the profile is written to the profiles directory
 # Returns: OK
 @app.route('/process', methods=['GET'])
 def process():
-  global packingProcess
-  global currentlyPacking
-  
   svgfile = request.args.get('svgfile')
   copies = int(request.args.get('copies'))
   print(copies)
-  
-  # read illustrator svg file and call packing
-  with open(svgfile, 'r') as myfile:
-    fabricaidedoc = myfile.read().strip()
 
-  # Remove old packed files
-  if (os.path.exists(PACKED_PREVIEW_DIR)):
-    shutil.rmtree(PACKED_PREVIEW_DIR)
-  os.mkdir(PACKED_PREVIEW_DIR)
+  # Execute packing (old packed previews are removed once
+  # any superseded packing has stopped)
+  start_packing(svgfile, copies, profile_requested())
+      
+  return 'OK'
 
-  # Execute packing
-  packingProcess.loadFile(svgfile, copies)
-  
+# Start packing the given SVG file, superseding any
+# packing that is still in flight
+def start_packing(svgfile, copies, profile=False):
   print('packing...')
-  packingProcess.packAsync() # start the packing process
-  currentlyPacking = True
-      
+  generation = packer.request(svgfile, copies, profile) # hand the packing to the packer
+  print('packing generation {}'.format(generation))
+
+# Make sure that this process takes part in packing. The
+# packer thread is started lazily, since processes of a
+# WSGI server may be forked after this module is loaded
+@app.before_request
+def start_packer():
+  packer.start()
+
+# Record the latency of every request, by endpoint
+@app.before_request
+def start_timer():
+  g.start = time.perf_counter()
+
+@app.after_request
+def record_latency(response):
+  if 'start' in g:
+    fabricade_metrics.metrics.observe('fabricaide_request_seconds', time.perf_counter() - g.start, endpoint=request.endpoint or 'unknown')
+  return response
+
+# Return performance metrics: durations of the stages of
+# packing, counts of what was packed, PNG render times and
+# request latencies
+#
+# returns: The metrics in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+def serve_metrics():
+  return fabricade_metrics.metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+# Watch the given SVG file and process it whenever its
+# content changes, as /process would. Clients pick up
+# the results through /check_refresh. Replaces any file
+# that was being watched before
+#
+# args:
+#  svgfile: The filename of the SVG file
+#  copies: The number of copies that should be packed
+# Returns: OK
+@app.route('/watch', methods=['GET'])
+def watch():
+  svgfile = request.args.get('svgfile')
+  copies = int(request.args.get('copies', 1))
+  start_watching(svgfile, copies)
+  return 'OK'
+
+def start_watching(svgfile, copies):
+  state.set(WATCH_KEY, {'svgfile': svgfile, 'copies': copies})
+  packer.start()
+
+# Watch the file recorded in the state store. Runs in the
+# process that holds the packer lease, so that only one
+# process watches the file
+def sync_watcher():
+  global designWatcher
+  global watchedDesign
+  watch = state.get(WATCH_KEY)
+  if watch == watchedDesign:
+    return
+  if designWatcher is not None:
+    designWatcher.stop()
+    designWatcher = None
+  watchedDesign = watch
+  if watch is not None:
+    designWatcher = fabricade_watcher.DesignWatcher(watch['svgfile'], lambda filename: start_packing(filename, watch['copies']))
+    designWatcher.start()
+
+packer.addTask(sync_watcher)
+
+# Stop watching the SVG file
+#
+# Returns: OK
+@app.route('/unwatch', methods=['GET'])
+def unwatch():
+  state.set(WATCH_KEY, None)
+  return 'OK'
+
+# Submit a design to the packing job queue. The job packs
+# a snapshot of the design into its own output directories
+#
+# args:
+#  svgfile: The filename of the SVG file
+#  copies: The number of copies that should be packed
+#  user (optional): The user submitting the job. Each user
+#    may only have a limited number of jobs running at once
+#  priority (optional): Jobs with a higher priority run first
+# Returns: A JSON string consisting of
+#  job (string): The ID of the new job
+@app.route('/jobs/submit', methods=['GET', 'POST'])
+def submit_job():
+  svgfile = request.values.get('svgfile')
+  copies = int(request.values.get('copies', 1))
+  user = request.values.get('user', 'anonymous')
+  priority = int(request.values.get('priority', 0))
+  jobid = scheduler.submit(svgfile, copies, user, priority)
+  return json.dumps({'job': jobid})
+
+# Return the status of every packing job that is queued or
+# running, and of the most recently finished ones
+#
+# Returns: A JSON string consisting of
+#  jobs (list): The status of each job, as for /jobs/<job id>
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+  return json.dumps({'jobs': scheduler.statuses()})
+
+# Return the status of the given packing job
+#
+# Returns: A JSON string consisting of the state of the job
+#  (queued, running, done, failed or cancelled), its output
+#  directories, and once it is done, its results in the same
+#  format as /check_refresh
+@app.route('/jobs/<jobid>', methods=['GET'])
+def job_status(jobid):
+  status = scheduler.status(jobid)
+  if status is None:
+    return json.dumps({'error': 'No such job'}), 404
+  return json.dumps(status)
+
+# Cancel the given packing job
+#
+# Returns: OK, or an error if the job is not queued or running
+@app.route('/jobs/<jobid>/cancel', methods=['GET', 'POST'])
+def cancel_job(jobid):
+  if not scheduler.cancel(jobid):
+    return json.dumps({'error': 'Job is not queued or running'}), 404
   return 'OK'
 
 # Compute the maximum number of copies of the given design
-# that can be packed onto the available material
+# that can be packed onto the available material, without
+# writing any packed files or previews. The answer comes
+# from the speculation cache if it has been precomputed
 #
 # args:
 #  svgfile: The filename of the SVG file
-# Returns: A JSON string consisting of an integral field, maxcopies
+#  profile (optional): If true, the computation is profiled
+#    (and the cache is not used)
+# Returns: A JSON string consisting of an integral field, maxcopies,
+#  a boolean field, cached, and with profile, the list of profile
+#  files that were written
 @app.route('/maxcopies', methods=['GET'])
 def maxcopies():
   svgfile = request.args.get('svgfile')
-  
-  # read illustrator svg file and call packing
-  with open(svgfile, 'r') as myfile:
-    fabricaidedoc = myfile.read().strip()
+  materialcuts, partcounts = packingProcess.readParts(svgfile)
+  design = speculator.designKey(materialcuts, partcounts)
 
-  # Remove old packed files
-  if (os.path.exists(PACKED_PREVIEW_DIR)):
-    shutil.rmtree(PACKED_PREVIEW_DIR)
-  os.mkdir(PACKED_PREVIEW_DIR)
+  profile = profile_requested()
+  if not profile:
+    answer = speculator.maxCopies(design)
+    if answer is not None:
+      return json.dumps({'maxcopies': answer, 'cached': True})
 
-  # Execute packing
+  # Every probe is a dry run, so the packed files are left as they are
   print('Starting maxcopies computation. This might take a while...')
-  answer = packingProcess.computeMaxCopies(svgfile)
+  if profile:
+    with fabricade_profiler.profiler.profile('maxcopies') as files:
+      answer = packingProcess.maxCopies(materialcuts, partcounts)
+  else:
+    answer = packingProcess.maxCopies(materialcuts, partcounts)
   print('Finished maxcopies computation.')
-  return json.dumps({'maxcopies': answer})
+  speculator.store(design, maxcopies=answer)
+  if profile:
+    return json.dumps({'maxcopies': answer, 'cached': False, 'profile': files})
+  return json.dumps({'maxcopies': answer, 'cached': False})
+
+# Check whether the given number of copies of the given
+# design can be packed onto the available material, with
+# a dry run unless the answer has been precomputed
+#
+# args:
+#  svgfile: The filename of the SVG file
+#  copies: The number of copies
+# Returns: A JSON string consisting of boolean fields, fits
+#  and cached
+@app.route('/fits', methods=['GET'])
+def fits():
+  svgfile = request.args.get('svgfile')
+  copies = int(request.args.get('copies'))
+  materialcuts, partcounts = packingProcess.readParts(svgfile)
+  design = speculator.designKey(materialcuts, partcounts)
+
+  answer = speculator.fits(design, copies)
+  if answer is not None:
+    return json.dumps({'fits': answer, 'cached': True})
+  answer, _ = packingProcess.dryRun(materialcuts, partcounts, copies)
+  speculator.store(design, fits={str(copies): answer})
+  return json.dumps({'fits': answer, 'cached': False})
+
+# Return True if the request asks to be profiled
+def profile_requested():
+  return request.args.get('profile', '').lower() in ['1', 'true', 'yes']
+
+# Profile the next packing run, whichever request starts it
+#
+# Returns: OK
+@app.route('/profile_next_packing', methods=['GET'])
+def profile_next_packing():
+  packer.profileNext()
+  return 'OK'
+
+# Report the memory usage of every process of the service:
+# the peak and retained memory of the most recent packing
+# job and of each of its stages, and while memory is being
+# traced, the largest allocation sites and the sites that
+# have grown the most since tracing started
+#
+# args:
+#  trace (optional): Turn memory tracing on in every process,
+#    keeping the given number of frames per allocation, or
+#    turn it off with 0. Tracing slows packing down
+# Returns: A JSON string consisting of
+#  processes (list): The memory report of each process
+@app.route('/memory', methods=['GET'])
+def memory():
+  if 'trace' in request.args:
+    fabricade_memory.memorytracker.setTracing(int(request.args.get('trace')))
+  else:
+    fabricade_memory.memorytracker.sync()
+  return json.dumps({'processes': fabricade_memory.memorytracker.reports()})
+
+# Return the profiles that have been taken
+#
+# Returns: A JSON string consisting of
+#  profiles (list): The name, size and modification time of
+#    each profile file, newest first
+@app.route('/profiles', methods=['GET'])
+def list_profiles():
+  return json.dumps({'profiles': fabricade_profiler.profiler.profiles()})
+
+# Download the given profile file
+@app.route('/profiles/<filename>', methods=['GET'])
+def get_profile(filename):
+  return send_from_directory(os.path.abspath(fabricade_profiler.profiler.directory), filename, as_attachment=True)
 
 
 # Return a page containing 'content' surrounded by the header and footer
@@ -193,8 +457,7 @@ def make_content(content):
 
 @app.route('/materials', methods=['GET'])
 def serve_mat_db():
-  with open(MAT_DB, 'r') as file:
-    materialsdb = json.load(file)
+  materialsdb = materialdb.load()
   materialcolour = {v:k for k,v in materialsdb['fillmappings'].items()}
     
   content = '<h1>Materials Database</h1>'  
@@ -268,7 +531,8 @@ def convert_to_png():
   sheetid = request.args.get('sheetid')
 
   pngout = os.path.join(PACKED_PREVIEW_DIR, material+'_'+str(sheetid)+'.png')
-  svg2png(url='cuts/'+material+'_'+sheetid+'.svg', write_to=pngout)
+  with open('cuts/'+material+'_'+sheetid+'.svg', 'rb') as svgfile:
+    fabricade_previews.previewservice.render(svgfile.read(), pngout)
   return 'OK'
 
 # Send the given job to the laser cutter
@@ -326,32 +590,58 @@ def check_lasercut():
 
 # Check whether the UI should be refreshed because
 # packing has completed and new material data has
-# become available
+# become available. With the wait argument, this is
+# a long poll: the response is sent as soon as there
+# are results that have not been reported yet, or once
+# the wait is over. If the newest results have already
+# been reported, it waits for the next packing
 #
-# args: None
+# args:
+#  wait (optional): The longest time in seconds to wait for new
+#    results (capped at REFRESH_WAIT_LIMIT)
 # returns: A JSON string consisting of
 #  refresh (bool): True if a refresh is required
 #  usage (string -> float list) : A map from materials to percentage usage for each sheet. The first percentage is the total usage across all sheets
 #  insufficient (string list): A list of materials for which not all shapes could be packed
+#  packed_area (string -> float): A map from materials to the area of their sheets that the packed shapes take up
+#  generation (int): The packing generation that the results belong to
+#  timings (dict): Seconds spent in each stage of the packing, in total
+#    (stages) and per material (materials), and the total time (total)
+#  counts (dict): The numbers of parts, materials, reused materials,
+#    packed sheets, failed fits and crashed materials of the packing
+#  memory (dict): While memory is traced (see /memory), the peak and
+#    retained memory of the packing (job) and of each stage (stages)
+#  substitutes (dict): The substitutes for the insufficient materials
+#    of the newest packing (see fabricade_speculation): its generation,
+#    whether substitutes are still being packed (pending), and a map
+#    (materials) from insufficient materials to their substitutes, each
+#    with whether the shapes that did not fit would all fit onto it
+#    (fits) and how many would not (failed_fits). Null until the newest
+#    packing has completed
+#  error (string): Why the newest packing failed, in which case
+#    refresh is False and only generation and substitutes are given
 #
-# The second two will be absent if refresh is False
+# Only the newest packing generation is ever reported. All
+# but refresh and substitutes will be absent if refresh is False
+# (except when reporting an error).
+# Substitutes are packed after the results are reported, so keep
+# polling to learn about them
 @app.route('/check_refresh', methods=['GET'])
 def check_refresh():
-  global packingProcess
-  global currentlyPacking
-  if currentlyPacking and packingProcess.packingIsDone():
-    currentlyPacking = False
-    return json.dumps(
-      {
-        'refresh': True,
-        'usage': packingProcess.percentages,
-        'insufficient': packingProcess.insufficientmaterials,
-        'crashed': packingProcess.crashedmaterials,
-        'failed_fits': packingProcess.failed_fits
-      }
-    )
+  wait = min(float(request.args.get('wait', 0)), REFRESH_WAIT_LIMIT)
+  if wait > 0:
+    packer.waitForResults(wait)
+
+  record = packer.takeResults()
+  if record is not None and record.get('error'):
+    payload = {'refresh': False, 'generation': record['completed'], 'error': record['error']}
+  elif record is not None:
+    payload = {'refresh': True, 'generation': record['completed']}
+    payload.update(record['results'])
   else:
-    return json.dumps({'refresh': False})
+    payload = {'refresh': False}
+  payload['substitutes'] = speculator.substitutes()
+  return json.dumps(payload)
 
 # Update the material database with the given job file
 #
@@ -376,11 +666,12 @@ def update_material_database():
 # Reset the cuts dictionary to force repacking
 @app.route('/reset_cache', methods=['GET'])
 def reset_cache():
-  packingProcess.reset_cache()
+  packer.reset()
   return 'OK'
 
-# Generate all of the thumbnail images for the material
-# database.
+# Generate the thumbnail images for the material
+# database. Only sheets that have changed since their
+# thumbnail was generated are rendered again.
 #
 # Arguments: None
 # Returns: OK
@@ -389,6 +680,23 @@ def generate_thumbnails():
   fabricade_svgutils.generateThumbnails()
   return 'OK'
 
+# Generate the thumbnail images of the given sheets
+# of the material database, whether or not they have
+# changed.
+#
+# args:
+#   sheets: A comma-separated list of sheets, named
+#     <material name>_<sheet id> like the packed files
+# Returns: OK
+@app.route('/generate_sheet_thumbnails', methods=['GET'])
+def generate_sheet_thumbnails():
+  sheets = []
+  for sheet in request.args.get('sheets').split(','):
+    matname, sheetid = sheet.rsplit('_', 1)
+    sheets.append((matname, int(sheetid)))
+  fabricade_svgutils.generateSheetThumbnails(sheets)
+  return 'OK'
+
 # Add an SVG group that displays the holes in a sheet
 # to the given packed SVG file.
 #
@@ -429,31 +737,22 @@ def open_file():
   os.system('open {}'.format(svgfile))
   return 'OK'
 
-# Return a list of similar materials
+# Return a list of similar materials that still have free
+# area, from the substitute index (see fabricade_substitutes).
+# The area that the newest packing takes up is not counted
+# as free
 #
 # args:
 #  matname: The baseline material
 #
 # Returns: A JSON string consisting of
-#   substitutes (string list): A list of of substitute material names
+#   substitutes (string list): A list of of substitute material names,
+#     those of the same colour first, then those of the same thickness
 @app.route('/get_similar_materials', methods=['GET'])
 def get_similar_materials():
-  with open(MAT_DB, 'r') as infile:
-    matdb = json.load(infile)
   matname = request.args.get('matname')
-  mat_thickness = matname.split('-')[0]
-  mat_color = matname.split('-')[1]
-
-  colorsubs = []
-  thicknesssubs = []
-  for material in matdb['materialinfo'].keys():
-    if material != matname:
-      if len(thicknesssubs) < 2 and material.split('-')[0] == mat_thickness:
-        thicknesssubs.append(material)
-      elif len(colorsubs) < 2 and material.split('-')[1] == mat_color:
-        colorsubs.append(material)
-
-  subs = colorsubs+thicknesssubs
+  used = (packer.record().get('results') or {}).get('packed_area')
+  subs = fabricade_substitutes.substituteindex.similarMaterials(matname, used)
   return json.dumps({"substitutes": subs})
 
 @app.route('/sheetphoto', methods=['GET'])
@@ -464,8 +763,7 @@ def sheetphoto():
 # Add a blank sheet
 @app.route('/addblank', methods=['GET','POST'])
 def add_blank_sheet():
-  with open(MAT_DB, 'r') as file:
-    materialsdb = json.load(file)
+  materialsdb = materialdb.load()
 
   newmatname = request.args.get('matname')
   viewbox = materialsdb['materialinfo'][newmatname]['viewBox']
@@ -473,21 +771,17 @@ def add_blank_sheet():
   svgstring = '<svg xmlns="http://www.w3.org/2000/svg" width="{}" height="{}" viewBox="{}"></svg>'.format(width, height, viewbox)
 
   
-  materialsdb['materialsheets'][newmatname].append(svgstring) 
-
-  with open(MAT_DB, 'w') as outfile:
-    json.dump(materialsdb, outfile)
+  materialdb.appendSheet(newmatname, svgstring)
 
   return redirect(url_for('serve_mat_db'))
 
 # Upload a new material
 @app.route('/register', methods=['GET','POST'])
 def register_material():
-  global registration_material
-
   if request.method == 'POST':
 
     registration_material = request.form.get('matname')
+    state.set(REGISTRATION_KEY, registration_material)
     filefield = 'newsheet-{}'.format(registration_material)
 
     if filefield not in request.files: 
@@ -505,18 +799,16 @@ def register_material():
   else:
     x,y = map(int, list(request.args.keys())[0].split(','))
     newsheet = fabricaide_contours.extractContours('sheetphoto.jpg', x,y)
+    registration_material = state.get(REGISTRATION_KEY)
 
     return make_content(REGISTER_PAGE.format(newsheet,registration_material)) 
 
 # Confirm registering a new material
 @app.route('/registerdone', methods=['POST'])
 def register_done():
-  global registration_material
-
-  with open(MAT_DB, 'r') as file:
-    materialsdb = json.load(file) 
+  materialsdb = materialdb.load()
 
-  newmatname = registration_material
+  newmatname = state.get(REGISTRATION_KEY)
   newsheet = request.form.get('newsheet')
   
   # Scale the material sheet to the correct dimensions
@@ -547,10 +839,7 @@ def register_done():
   for attr in ['width', 'height', 'viewBox']:
     svgroot.setAttribute(attr, materialsdb['materialinfo'][newmatname][attr])
   
-  materialsdb['materialsheets'][newmatname].insert(0, dom.toxml()) 
-
-  with open(MAT_DB, 'w') as outfile:
-    json.dump(materialsdb, outfile)
+  materialdb.insertSheet(newmatname, 0, dom.toxml())
 
   return redirect(url_for('serve_mat_db'))
 
@@ -572,7 +861,19 @@ if __name__ == "__main__":
   argparser = argparse.ArgumentParser()
   argparser.add_argument('--laser-host', dest='laser_host', default='http://127.0.0.1:8000', help='Remote hostname of laser cutter')
   argparser.add_argument('--port', dest='port', default=3000, type=int, help='Port to serve the local service on')
+  argparser.add_argument('--packing-workers', dest='packing_workers', default=fabricade_packing.PACKING_WORKERS, type=int, help='Number of processes used to pack materials in parallel')
+  argparser.add_argument('--watch', dest='watch', default=None, help='SVG file to watch and pack whenever it changes')
+  argparser.add_argument('--copies', dest='copies', default=1, type=int, help='Number of copies to pack in watch mode')
   args = argparser.parse_args()
+  packingProcess.workers = args.packing_workers
+
+  # Have the substitutes ready before the first request for them
+  fabricade_substitutes.substituteindex.update()
+
+  if args.watch is not None:
+    start_watching(args.watch, args.copies)
+  else:
+    state.set(WATCH_KEY, None)
 
   # Test if the laser cutter server is running
   # remoteLaser = RemoteLaserCutter(args.laser_host)
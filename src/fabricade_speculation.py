@@ -0,0 +1,233 @@
+# Speculative work done while the packer is idle
+#
+# Once the packer is idle, the process that holds the packer lease uses the
+# time to prepare for what operators are likely to ask for next. Speculative
+# packing runs in processes of its own, at a lower priority than the rest of
+# Fabricaide, so that it never holds up a real packing. As soon as a new
+# packing request is recorded, the speculative work that has not started yet
+# is dropped and those processes are shut down. A packing that one of them
+# is in the middle of is left to finish at its lower priority, and its
+# result is thrown away.
+#
+# When some parts of the design did not fit onto their material, the UI
+# offers substitute materials. The parts that did not fit are packed onto
+# each substitute (along with the parts that are already made of it), and
+# the packing is kept, so that switching those parts over to a substitute
+# does not have to pack it again. Which substitutes would hold all their
+# parts is reported through the state store.
+#
+# Operators also often ask for more copies of a design right after it has
+# been packed, so the speculator works out whether one and two more copies
+# of the design that was packed last would fit, and the maximum number of
+# copies that fit. The answers are kept in the shared state store against
+# the fingerprint of the design and the version of the material database,
+# so that /maxcopies and /fits can answer straight away in any process.
+# Only the answers for the most recent design are kept.
+#
+# Provides:
+#   Speculator: precomputes substitute packings and copy counts
+
+import concurrent.futures
+import multiprocessing
+import os
+import threading
+import traceback
+
+import fabricade_packing
+import fabricade_substitutes
+
+SPECULATION_KEY = 'speculation'               # Cached answers about copies in the state store
+SUBSTITUTES_KEY = 'speculation.substitutes'   # Substitutes for the materials that did not fit
+EXTRA_COPIES = [1, 2]                         # Numbers of copies beyond the packed ones that are tried
+
+# Number of processes that speculative packing runs in, and how much lower
+# their scheduling priority is
+SPECULATION_WORKERS = int(os.environ.get('FABRICAIDE_SPECULATION_WORKERS', '1'))
+SPECULATION_NICENESS = 10
+
+# Lower the priority of a speculation process. This runs in the process
+def lowerPriority():
+  if hasattr(os, 'nice'):
+    os.nice(SPECULATION_NICENESS)
+
+class Speculator:
+  def __init__(self, packing, state, packer):
+    self.packing = packing
+    self.state = state
+    self.packer = packer
+    self.substituteindex = fabricade_substitutes.substituteindex
+    self.thread = None
+
+    # Processes that speculative packing runs in (see start())
+    self.executor = None
+
+    # Packing generation that speculation was last started for
+    self.generation = None
+
+  # Start speculating about the design that was packed last, once the
+  # packer is idle. This is a task of the packer (see fabricade_worker)
+  def dispatch(self):
+    record = self.packer.record()
+    # A newer request needs the processors, so speculation stops straight away
+    if record.get('requested', 0) != self.generation:
+      self.stop()
+    generation = record.get('completed', 0)
+    if generation == 0 or generation != record.get('requested', 0) or generation == self.generation:
+      return
+    # There is nothing to speculate about if the packing failed
+    if record.get('error'):
+      return
+    # Speculation about an older design stops at its next probe
+    if self.thread is not None and self.thread.is_alive():
+      return
+    self.generation = generation
+    substitutions = self.planSubstitutions(record, generation)
+    executor = self.start()
+    self.thread = threading.Thread(target=self.speculate, args=(record, generation, substitutions, executor), daemon=True)
+    self.thread.start()
+
+  # Return the processes that speculative packing runs in, starting them if
+  # necessary. Like the packing workers, they are started from a fork server
+  # (see PackingJob.getPool())
+  def start(self):
+    if self.executor is None:
+      self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=SPECULATION_WORKERS, mp_context=multiprocessing.get_context('forkserver'), initializer=lowerPriority)
+    return self.executor
+
+  # Shut down the processes that speculative packing runs in, cancelling
+  # the packings that have not started. The speculation thread notices that
+  # it has been cancelled and stops without waiting for the packing in
+  # progress, after which its process exits
+  def stop(self):
+    executor, self.executor = self.executor, None
+    if executor is not None:
+      executor.shutdown(wait=False, cancel_futures=True)
+
+  # Plan packing the parts that did not fit onto the substitutes of their
+  # materials (see PackingJob.planSubstitution()). This reads the state of
+  # the packing, so it runs in the packer thread while the packing is idle.
+  # Returns a list of (material, substitute, plan) tuples
+  def planSubstitutions(self, record, generation):
+    self.packing.clearSubstitutePackings()
+    insufficient = (record.get('results') or {}).get('insufficient', [])
+    used = (record.get('results') or {}).get('packed_area')
+    self.state.set(SUBSTITUTES_KEY, {'generation': generation, 'pending': len(insufficient) > 0, 'materials': {}})
+
+    # The design may have been packed by another process
+    if self.packing.generation != generation:
+      return []
+
+    substitutions = []
+    for material in insufficient:
+      for substitute in self.substituteindex.similarMaterials(material, used):
+        try:
+          plan = self.packing.planSubstitution(material, substitute)
+        except Exception:
+          traceback.print_exc()
+          continue
+        if plan is not None:
+          substitutions.append((material, substitute, plan))
+    return substitutions
+
+  # Body of the speculation thread, which packs on the given executor
+  def speculate(self, record, generation, substitutions, executor):
+    cancelled = lambda: self.packer.record().get('requested', 0) != generation
+    try:
+      for material, substitute, (sheets, shapes, sheetversions, fingerprint) in substitutions:
+        if cancelled():
+          return
+        try:
+          result = self.packing.awaitProbe(executor.submit(fabricade_packing.packShapes, sheets, shapes), cancelled)
+        except Exception:
+          if cancelled():
+            return
+          traceback.print_exc()
+          continue
+        if result is None:
+          return
+        self.packing.addSubstitutePacking(substitute, sheetversions, fingerprint, result)
+        self.storeSubstitute(generation, material, substitute, result[2])
+      self.storeSubstitute(generation)
+
+      materialcuts, partcounts = self.packing.readParts(record['svgfile'])
+      design = self.designKey(materialcuts, partcounts)
+      for extra in EXTRA_COPIES:
+        copies = record['copies'] + extra
+        if self.fits(design, copies) is not None:
+          continue
+        result = self.packing.dryRun(materialcuts, partcounts, copies, cancelled=cancelled, executor=executor)
+        if result is None:
+          return
+        self.store(design, fits={str(copies): result[0]})
+
+      if self.maxCopies(design) is None:
+        maxcopies = self.packing.maxCopies(materialcuts, partcounts, cancelled, executor, SPECULATION_WORKERS)
+        if maxcopies is None:
+          return
+        self.store(design, maxcopies=maxcopies)
+      print('[Speculation] Precomputed the copies of generation {} that fit'.format(generation))
+    except Exception:
+      # Once the executor is shut down, new work cannot be submitted to it
+      if not cancelled():
+        traceback.print_exc()
+
+  # Record how many of the parts that did not fit onto the given material
+  # fail to fit onto the given substitute. Without a material, records that
+  # all substitutes have been packed
+  def storeSubstitute(self, generation, material=None, substitute=None, failed_fits=0):
+    def add(entry):
+      if entry is None or entry['generation'] != generation:
+        return entry
+      if material is None:
+        entry['pending'] = False
+      else:
+        entry['materials'].setdefault(material, {})[substitute] = {'fits': failed_fits == 0, 'failed_fits': failed_fits}
+      return entry
+    self.state.update(SUBSTITUTES_KEY, add)
+
+  # Return the substitutes for the materials of the most recent packing that
+  # did not fit: a dict with the generation of the packing, whether more
+  # substitutes are still being packed, and a map from materials to their
+  # substitutes, with whether the parts would fit and how many would not
+  def substitutes(self):
+    entry = self.state.get(SUBSTITUTES_KEY)
+    if entry is None or entry['generation'] != self.packer.record().get('completed', 0):
+      return None
+    return entry
+
+  # Return the key that answers about the given parts are cached against
+  def designKey(self, materialcuts, partcounts):
+    return [self.packing.designFingerprint(materialcuts, partcounts), self.packing.materialdb.version()]
+
+  # Return the cached answers about the given design, which may be empty
+  def cached(self, design):
+    entry = self.state.get(SPECULATION_KEY)
+    if entry is None or entry['design'] != design:
+      return {}
+    return entry
+
+  # Return whether the given number of copies of the design fit, or None
+  # if this is not known
+  def fits(self, design, copies):
+    entry = self.cached(design)
+    if entry.get('maxcopies') is not None:
+      return copies <= entry['maxcopies']
+    return entry.get('fits', {}).get(str(copies))
+
+  # Return the maximum number of copies of the design that fit, or None if
+  # this is not known
+  def maxCopies(self, design):
+    return self.cached(design).get('maxcopies')
+
+  # Add answers about the given design to the cache, replacing the answers
+  # about any other design
+  def store(self, design, fits=None, maxcopies=None):
+    def add(entry):
+      if entry is None or entry['design'] != design:
+        entry = {'design': design, 'fits': {}, 'maxcopies': None}
+      if fits is not None:
+        entry['fits'].update(fits)
+      if maxcopies is not None:
+        entry['maxcopies'] = maxcopies
+      return entry
+    self.state.update(SPECULATION_KEY, add)
@@ -0,0 +1,135 @@
+# Service state shared between processes
+#
+# The service may run in several processes at once (e.g. several gunicorn
+# workers), so anything that has to outlive a single request is kept here
+# rather than in module globals. This is a small key-value store on top of
+# SQLite in WAL mode; values are anything that can be stored as JSON, and
+# updates are atomic across processes.
+#
+# Provides:
+#   StateStore: the key-value store, with leases for electing one process
+#               to do work that must not run more than once at a time
+#   processRunning: whether a process of the service is still running
+
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+STATE_DB = 'service-state.db'
+
+class StateStore:
+  def __init__(self, path=STATE_DB):
+    self.path = path
+    self.initialized = False
+    self.initLock = threading.Lock()
+
+  # Open a new connection. Connections are not shared between threads
+  def connect(self):
+    if not self.initialized:
+      with self.initLock:
+        if not self.initialized:
+          conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+          conn.execute('PRAGMA journal_mode=WAL')
+          conn.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+          conn.close()
+          self.initialized = True
+    conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+  # Run the body in a write transaction
+  @contextlib.contextmanager
+  def transaction(self):
+    conn = self.connect()
+    try:
+      conn.execute('BEGIN IMMEDIATE')
+      yield conn
+      conn.execute('COMMIT')
+    except:
+      conn.execute('ROLLBACK')
+      raise
+    finally:
+      conn.close()
+
+  def read(self, conn, key, default):
+    row = conn.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+    return json.loads(row[0]) if row is not None else default
+
+  def write(self, conn, key, value):
+    conn.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+
+  # Return the value of the given key
+  def get(self, key, default=None):
+    conn = self.connect()
+    try:
+      return self.read(conn, key, default)
+    finally:
+      conn.close()
+
+  # Return the (key, value) pairs of every key that starts with the given prefix
+  def items(self, prefix):
+    conn = self.connect()
+    try:
+      rows = conn.execute('SELECT key, value FROM state WHERE substr(key, 1, ?) = ?', (len(prefix), prefix)).fetchall()
+      return [(key, json.loads(value)) for key, value in rows]
+    finally:
+      conn.close()
+
+  # Return the (key, value) pairs of every key that is the given prefix
+  # followed by the ID of a process that is still running. The keys of
+  # processes that have exited are removed
+  def processItems(self, prefix):
+    items = []
+    for key, value in self.items(prefix):
+      if processRunning(int(key[len(prefix):])):
+        items.append((key, value))
+      else:
+        self.delete(key)
+    return items
+
+  # Set the value of the given key
+  def set(self, key, value):
+    with self.transaction() as conn:
+      self.write(conn, key, value)
+
+  # Remove the given key
+  def delete(self, key):
+    with self.transaction() as conn:
+      conn.execute('DELETE FROM state WHERE key = ?', (key,))
+
+  # Atomically replace the value of the given key with update(value).
+  # Returns the new value
+  def update(self, key, update, default=None):
+    with self.transaction() as conn:
+      value = update(self.read(conn, key, default))
+      self.write(conn, key, value)
+      return value
+
+  # Atomically add one to the given counter and return its new value
+  def increment(self, key):
+    return self.update(key, lambda value: value + 1, 0)
+
+  # Try to take (or keep) the named lease for the given owner. A lease that
+  # has not been renewed for ttl seconds is free to be taken by another
+  # owner. Returns True if the owner holds the lease
+  def acquireLease(self, name, owner, ttl):
+    now = time.time()
+    def take(lease):
+      if lease is None or lease['owner'] == owner or lease['expires'] < now:
+        return {'owner': owner, 'expires': now + ttl}
+      return lease
+    return self.update('lease:' + name, take)['owner'] == owner
+
+# Return True if the process with the given ID is running. The processes
+# of the service share the state store, so they run on the same machine
+def processRunning(pid):
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    pass
+  return True
@@ -0,0 +1,160 @@
+# Index of substitute materials
+#
+# When some parts of a design do not fit onto their material, the UI offers
+# substitutes for it: materials of the same colour, and materials of the
+# same thickness. The substitutes of every material are worked out ahead of
+# time, so that looking them up is a single dictionary access, and they are
+# worked out again whenever the material database changes: right after
+# every write made by this process, regularly in the process that holds the
+# packer lease (see fabricade_service), and otherwise when they are looked
+# up after another process has written to the database.
+#
+# Material names are of the form <thickness>-<colour>-<type>. A material of
+# both the same thickness and the same colour is offered as one of the same
+# thickness, unless there are already enough of those. Among the
+# materials of the same colour, or of the same thickness, the ones of the
+# same type come first, followed by the others, each with the most free area
+# (the area of their sheets that has not been cut out yet) first. Materials
+# that have no free area left are never offered. When substitutes are looked
+# up for a packing, the area that the packing takes up on each material is
+# left out of its free area, since it will be cut out next. Those rankings
+# are kept for as long as the packing and the database stay the same.
+#
+# The free area of every sheet is cached against the version of the sheet
+# in the material database, so after a write only the sheets that were
+# written are measured again.
+#
+# Provides:
+#   SubstituteIndex: the substitutes of every material, ranked by supply
+#   substituteindex: the SubstituteIndex shared by all of Fabricaide
+
+import threading
+import traceback
+
+import fabricade_geometry
+import fabricade_matdb
+
+SUBSTITUTES_PER_GROUP = 2   # Number of substitutes of the same colour, and of the same thickness
+
+# Return the thickness, colour and type in the given material name, with
+# None for any that are missing
+def describeMaterial(matname):
+  parts = matname.split('-', 2)
+  return tuple(parts + [None] * (3 - len(parts)))
+
+class SubstituteIndex:
+  def __init__(self, materialdb=None, geometrycache=None):
+    self.materialdb = materialdb if materialdb is not None else fabricade_matdb.materialdb
+    self.geometrycache = geometrycache if geometrycache is not None else fabricade_geometry.geometrycache
+    self.lock = threading.Lock()
+
+    # Version of the material database that the index was built for
+    self.version = None
+
+    # Map from (material, sheet ID) to (sheet version, free area of the sheet)
+    self.freeareas = {}
+
+    # Map from materials to the free area of all of their sheets
+    self.supply = {}
+
+    # Maps from thicknesses and colours to the materials that have them
+    self.bythickness = {}
+    self.bycolour = {}
+
+    # Map from materials to their substitutes, best first
+    self.substitutes = {}
+
+    # Areas taken up by the packing that usedsubstitutes was ranked for (see
+    # similarMaterials()), and the map from materials to those substitutes
+    self.usedkey = None
+    self.usedsubstitutes = {}
+
+    self.materialdb.addListener(self.update)
+
+  # Return the substitutes of the given material, best first: up to
+  # SUBSTITUTES_PER_GROUP of the same colour, followed by up to
+  # SUBSTITUTES_PER_GROUP of the same thickness. If given, used maps
+  # materials to the area of their sheets that the active packing takes up
+  # (see PackingJob.packedArea()), in which case the substitutes are ranked
+  # by what is left after it
+  def similarMaterials(self, matname, used=None):
+    with self.lock:
+      self.refresh()
+      if not used:
+        if matname in self.substitutes:
+          return list(self.substitutes[matname])
+        return self.rank(matname)
+
+      key = tuple(sorted(used.items()))
+      if key != self.usedkey:
+        self.usedkey = key
+        self.usedsubstitutes = {}
+      if matname not in self.usedsubstitutes:
+        self.usedsubstitutes[matname] = self.rank(matname, used)
+      return list(self.usedsubstitutes[matname])
+
+  # Bring the index up to date with the material database
+  def update(self):
+    with self.lock:
+      self.refresh()
+
+  # Body of update(). Must hold the lock
+  def refresh(self):
+    version = self.materialdb.version()
+    if version == self.version:
+      return
+
+    data = self.materialdb.load()
+    versions = self.materialdb.sheetVersions()
+    freeareas = {}
+    supply = {}
+    bythickness = {}
+    bycolour = {}
+    for material in data['materialinfo']:
+      total = 0
+      for sheetid in range(len(data['materialsheets'].get(material, []))):
+        key = (material, sheetid)
+        cached = self.freeareas.get(key)
+        if cached is None or cached[0] != versions.get(key):
+          cached = (versions.get(key), self.freeArea(material, sheetid))
+        freeareas[key] = cached
+        total += cached[1]
+      supply[material] = total
+
+      thickness, colour, _ = describeMaterial(material)
+      bythickness.setdefault(thickness, []).append(material)
+      bycolour.setdefault(colour, []).append(material)
+
+    self.freeareas = freeareas
+    self.supply = supply
+    self.bythickness = bythickness
+    self.bycolour = bycolour
+    self.substitutes = {material: self.rank(material) for material in data['materialinfo']}
+    self.usedkey = None
+    self.usedsubstitutes = {}
+    self.version = version
+
+  # Return the free area of the given sheet, or 0 if it cannot be measured
+  def freeArea(self, material, sheetid):
+    try:
+      return self.geometrycache.get(material, sheetid).freeArea()
+    except Exception:
+      traceback.print_exc()
+      return 0
+
+  # Return the substitutes of the given material from the current groups,
+  # leaving the given used areas out of the supply of each material
+  def rank(self, matname, used=None):
+    used = used or {}
+    thickness, colour, kind = describeMaterial(matname)
+    supply = lambda material: self.supply.get(material, 0) - used.get(material, 0)
+    def best(candidates):
+      candidates = [material for material in candidates if material != matname and supply(material) > 0]
+      return sorted(candidates, key=lambda material: (describeMaterial(material)[2] != kind, -supply(material)))
+
+    thicknesssubs = best(self.bythickness.get(thickness, []))[:SUBSTITUTES_PER_GROUP]
+    coloursubs = [material for material in best(self.bycolour.get(colour, [])) if material not in thicknesssubs]
+    return coloursubs[:SUBSTITUTES_PER_GROUP] + thicknesssubs
+
+# The substitute index shared by all of Fabricaide
+substituteindex = SubstituteIndex()
@@ -8,8 +8,11 @@
 #    file to the sheet with the given material name and sheet
 #    id. This essentially merges the two SVG files and applies
 #    the appropriate styles for each of the shapes
-#  generateThumbnails: Generates all of the thumbnail images
-#    for the material database
+#  generateThumbnails: Generates the thumbnail images of the
+#    sheets in the material database that have changed since
+#    their thumbnails were last generated
+#  generateSheetThumbnails: Generates the thumbnail images of
+#    the given sheets
 #  getCurrentPackedParts: Return a list of the SVG elements
 #    that are currently packed onto the given sheet
 #  removeTransform: Remove the transform attribute from an XML
@@ -17,11 +20,14 @@
 #  equalsIgnoreTransform: Return True if the two given SVG XML
 #   elements are equal ignoring their transform attribute
 
+import hashlib
 import json
 import os
+import threading
 import xml.dom.minidom as DOM
 
-from cairosvg import svg2png
+import fabricade_matdb
+import fabricade_previews
 
 # SVG elements and style for laser cuts
 SVG_SHAPE_ELEMENTS = ['circle', 'rect', 'ellipse', 'polygon', 'polyline', 'path']
@@ -29,21 +35,20 @@ CUT_STYLE = 'fill:none;stroke:red;stroke-width:1px'
 HOLE_STYLE = 'fill:#646464;stroke:none'
 
 # Material database
-MAT_DB = 'mat-data.txt'   # Material availability data
+materialdb = fabricade_matdb.materialdb   # Material availability data
 CUT_DIR = 'cuts'          # Currently packed cuts
 THUMB_DIR = 'FabricaideUI/data/matdb/'  # Material thumbnails
+THUMB_MANIFEST = os.path.join(THUMB_DIR, 'thumbnails.json')  # Hashes of the sheets that the thumbnails show
+thumbLock = threading.Lock()
 
 # Add the holes depicted in matname:sheetid to the
 # given SVG file
 def addHolesToSVG(svgfile, matname, sheetid):
-  with open(MAT_DB, 'r') as infile:
-    matdb = json.load(infile)
-
   shapes = DOM.parse(svgfile)
   svg = shapes.getElementsByTagName('svg')[0]
 
   # Copy the holes into the new group
-  holedom = DOM.parseString(matdb['materialsheets'][matname][sheetid])
+  holedom = DOM.parseString(materialdb.getSheet(matname, sheetid))
   holesvg = holedom.getElementsByTagName('svg')[0]
   for child in holesvg.childNodes:
     svg.appendChild(child.cloneNode(True))
@@ -99,16 +104,58 @@ def prepareForCutting(filename):
     f_out.write(doc.toxml())
   return newfilename
 
-# Generate all of the thumbnails for the material database
+# Generate the thumbnails for the material database. Only the sheets
+# whose SVG has changed since their thumbnail was generated are rendered
 def generateThumbnails():
-  with open(MAT_DB, 'r') as infile:
-    matdb = json.load(infile)
-  for material, sheets in matdb['materialsheets'].items():
-    for sheetid, sheet in enumerate(sheets):
+  matdb = materialdb.load()
+  sheets = [(material, sheetid) for material, materialsheets in matdb['materialsheets'].items()
+            for sheetid in range(len(materialsheets))]
+  renderThumbnails(matdb, sheets, False)
+
+# Generate the thumbnails of the given list of (material, sheet ID)
+# pairs, whether or not they have changed
+def generateSheetThumbnails(sheets):
+  renderThumbnails(materialdb.load(), sheets, True)
+
+# Return the hash of a sheet used to tell whether its thumbnail is up to date
+def sheetHash(sheet):
+  return hashlib.sha1(sheet.encode('utf-8')).hexdigest()
+
+# Render the thumbnails of the given sheets, skipping the ones that are
+# already up to date unless force is True
+def renderThumbnails(matdb, sheets, force):
+  with thumbLock:
+    try:
+      with open(THUMB_MANIFEST, 'r') as infile:
+        manifest = json.load(infile)
+    except (OSError, ValueError):
+      manifest = {}
+
+    renders = []
+    for material, sheetid in sheets:
+      sheet = matdb['materialsheets'][material][sheetid]
+      pngout = os.path.join(THUMB_DIR, material, str(sheetid)+'.png')
+      key = '{}/{}'.format(material, sheetid)
+      digest = sheetHash(sheet)
+      if not force and manifest.get(key) == digest and os.path.exists(pngout):
+        continue
+
       if not os.path.exists(os.path.join(THUMB_DIR, material)):
         os.makedirs(os.path.join(THUMB_DIR, material))
-      pngout = os.path.join(THUMB_DIR, material, str(sheetid)+'.png')
-      svg2png(bytestring=sheet, write_to=pngout)
+      renders.append((key, digest, fabricade_previews.previewservice.renderAsync(sheet, pngout)))
+
+    if len(renders) == 0:
+      return
+    print('Generating {} thumbnails'.format(len(renders)))
+
+    # Only record the thumbnails that were rendered successfully
+    for key, digest, render in renders:
+      if fabricade_previews.previewservice.wait([render]):
+        manifest[key] = digest
+
+    with open(THUMB_MANIFEST + '.tmp', 'w') as outfile:
+      json.dump(manifest, outfile)
+    os.replace(THUMB_MANIFEST + '.tmp', THUMB_MANIFEST)
 
 # Return an XML string corresponding to the given
 # XML string with the transform attribute removed,
@@ -155,10 +202,7 @@ def getCurrentPackedParts(matname, sheetid):
 # avoid adding nested parts (parts that were packed inside
 # another part's hole).
 def updateMaterialHoles(jobfile, matname, sheetid):
-  with open(MAT_DB, 'r') as infile:
-    matdb = json.load(infile)
-    
-  materialsheet = matdb['materialsheets'][matname][sheetid]
+  materialsheet = materialdb.getSheet(matname, sheetid)
   sheetdoc = DOM.parseString(materialsheet)
   sheetroot = sheetdoc.getElementsByTagName('svg')[0]
 
@@ -173,7 +217,5 @@ def updateMaterialHoles(jobfile, matname, sheetid):
   updated_sheet = sheetdoc.toxml()
   updated_sheet = updated_sheet.replace(CUT_STYLE, HOLE_STYLE)
 
-  matdb['materialsheets'][matname][sheetid] = updated_sheet
-
-  with open(MAT_DB, 'w') as outfile:
-    json.dump(matdb, outfile)
+  # Only this sheet is rewritten in the database
+  materialdb.setSheet(matname, sheetid, updated_sheet)
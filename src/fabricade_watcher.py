@@ -0,0 +1,119 @@
+# Watches a design file and reports when its content changes
+#
+# Uses file system notifications through the watchdog package (inotify,
+# FSEvents, ...) when it is installed, and falls back to polling the file's
+# modification time and size otherwise. Bursts of writes (e.g. Illustrator
+# exporting the document) are debounced, and the callback only fires when
+# the content of the file has actually changed and the file is a complete
+# SVG document.
+#
+# Provides:
+#   DesignWatcher: watches one design file
+
+import hashlib
+import os
+import threading
+import traceback
+
+try:
+  from watchdog.events import FileSystemEventHandler
+  from watchdog.observers import Observer
+except ImportError:
+  FileSystemEventHandler = object
+  Observer = None
+
+DEBOUNCE_DELAY = 0.3    # Seconds without writes before a change is handled
+POLL_INTERVAL = 0.25    # Seconds between checks when polling
+
+class DesignWatcher(FileSystemEventHandler):
+  # Watch the given file, calling onchange(filename) whenever its content changes
+  def __init__(self, filename, onchange, debounce=DEBOUNCE_DELAY, interval=POLL_INTERVAL):
+    self.filename = filename
+    self.path = os.path.abspath(filename)
+    self.onchange = onchange
+    self.debounce = debounce
+    self.interval = interval
+
+    self.lock = threading.Lock()
+    self.timer = None
+    self.observer = None
+    self.poller = None
+    self.stopped = threading.Event()
+
+    # Hash of the content that was last reported
+    self.digest = None
+
+  # Start watching. The current content of the file counts as a change
+  def start(self):
+    if Observer is not None:
+      self.observer = Observer()
+      self.observer.schedule(self, os.path.dirname(self.path), recursive=False)
+      self.observer.start()
+      print('[Watcher] Watching {} for changes'.format(self.filename))
+    else:
+      self.poller = threading.Thread(target=self.poll, daemon=True)
+      self.poller.start()
+      print('[Watcher] Polling {} for changes'.format(self.filename))
+    self.changed()
+
+  # Stop watching
+  def stop(self):
+    self.stopped.set()
+    if self.observer is not None:
+      self.observer.stop()
+    with self.lock:
+      if self.timer is not None:
+        self.timer.cancel()
+
+  # File system notification (watchdog)
+  def on_any_event(self, event):
+    paths = [getattr(event, 'src_path', None), getattr(event, 'dest_path', None)]
+    if self.path in [os.path.abspath(path) for path in paths if path]:
+      self.changed()
+
+  # Check the modification time and size of the file periodically
+  def poll(self):
+    signature = None
+    while not self.stopped.wait(self.interval):
+      try:
+        stat = os.stat(self.path)
+        current = (stat.st_mtime_ns, stat.st_size)
+      except OSError:
+        current = None
+      if current != signature:
+        signature = current
+        self.changed()
+
+  # The file may have changed. Handle it once the writes have settled down
+  def changed(self):
+    with self.lock:
+      if self.timer is not None:
+        self.timer.cancel()
+      if self.stopped.is_set():
+        return
+      self.timer = threading.Timer(self.debounce, self.settled)
+      self.timer.daemon = True
+      self.timer.start()
+
+  # Report the change if the content is new and complete
+  def settled(self):
+    try:
+      with open(self.path, 'rb') as infile:
+        content = infile.read()
+    except OSError:
+      return
+
+    # The file is still being written if the document is not closed
+    if not content.strip().endswith(b'</svg>'):
+      return
+
+    digest = hashlib.sha1(content).hexdigest()
+    if digest == self.digest:
+      return
+    self.digest = digest
+
+    print('[Watcher] {} has changed'.format(self.filename))
+    try:
+      self.onchange(self.filename)
+    except Exception:
+      traceback.print_exc()
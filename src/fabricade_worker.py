@@ -0,0 +1,301 @@
+# Background packing worker
+#
+# Requests to pack a design can arrive at any of the processes serving the
+# REST API, but only one process at a time may pack, since packing writes
+# the shared output directories. Requests are therefore recorded in the
+# shared state store, and every process runs a Packer that competes for the
+# packer lease. The process that holds the lease packs the newest request
+# and records the results in the store, where any process can report them.
+# A packing that fails is recorded along with its error instead, so that it
+# is not mistaken for the results of the packing before it.
+# If that process dies, another one takes over once the lease expires.
+#
+# An idle packer sleeps until this process asks it to pack (see wake()),
+# and otherwise only checks the store now and then for requests made in
+# other processes. The lease is renewed far less often than it is checked.
+#
+# Provides:
+#   Packer: requests packing, and packs while holding the lease
+
+import os
+import threading
+import time
+import traceback
+import uuid
+
+import fabricade_profiler
+
+PACKING_KEY = 'packing'           # Record of the requested and completed packing generations
+RESETS_KEY = 'packing.resets'     # Number of times the packing cache has been reset
+PROFILE_KEY = 'packing.profile'   # True if the next packing run should be profiled
+LEASE_NAME = 'packer'
+LEASE_TTL = 10                    # Seconds before the lease of a packer that has stopped expires
+LEASE_RENEWAL = LEASE_TTL / 4     # Seconds between renewals of the lease
+POLL_INTERVAL = 0.1               # Seconds between checks of the store while packing or waiting
+IDLE_INTERVAL = 1.0               # Longest time in seconds that an idle packer sleeps
+
+class Packer:
+  def __init__(self, packing, state):
+    self.packing = packing
+    self.state = state
+    self.profiler = fabricade_profiler.profiler
+    self.lock = threading.Lock()
+    self.thread = None
+    self.pid = None
+
+    # True while the packer thread of this process holds the lease, and
+    # when it was last renewed
+    self.leading = False
+    self.renewed = 0
+
+    # Condition that the idle packer thread sleeps on, and whether it has
+    # been woken up since it last went to sleep
+    self.wakeup = threading.Condition()
+    self.woken = False
+
+    # Number of generations that this process has finished packing, and a
+    # condition that is notified whenever it goes up
+    self.completions = 0
+    self.completed = threading.Condition()
+
+    # Functions that are run regularly while holding the lease
+    self.tasks = []
+
+    # Number of cache resets that the packing has seen
+    self.resets = None
+
+  # Run the given function regularly in the process that holds the lease
+  def addTask(self, task):
+    self.tasks.append(task)
+
+  # Start the packer thread of this process if it is not running yet. Also
+  # starts a new one in a forked process, since threads do not survive a fork
+  def start(self):
+    with self.lock:
+      if self.thread is not None and self.pid == os.getpid():
+        return
+      self.pid = os.getpid()
+      self.owner = '{}-{}'.format(self.pid, uuid.uuid4().hex)
+      self.thread = threading.Thread(target=self.run, daemon=True)
+      self.thread.start()
+
+  # Request packing of the given SVG file, superseding any packing that is
+  # still in flight. If profile is True, the packing run is profiled.
+  # Returns the generation number of the new request
+  def request(self, svgfile, copies, profile=False):
+    if profile:
+      self.profileNext()
+    def bump(record):
+      record['requested'] = record.get('requested', 0) + 1
+      record['svgfile'] = svgfile
+      record['copies'] = copies
+      return record
+    generation = self.state.update(PACKING_KEY, bump, {})['requested']
+    self.wake()
+    return generation
+
+  # Wake up the packer thread of this process if it is idle, so that it
+  # looks at the store and runs its tasks straight away
+  def wake(self):
+    with self.wakeup:
+      self.woken = True
+      self.wakeup.notify_all()
+
+  # Sleep until woken up (see wake()) or for the given number of seconds
+  def sleep(self, timeout):
+    with self.wakeup:
+      self.wakeup.wait_for(lambda: self.woken, timeout)
+      self.woken = False
+
+  # Profile the next packing run (see fabricade_profiler)
+  def profileNext(self):
+    self.state.set(PROFILE_KEY, True)
+
+  # Make the next packing run repack every material
+  def reset(self):
+    self.state.increment(RESETS_KEY)
+
+  # Return the record of the packing requests
+  def record(self):
+    return self.state.get(PACKING_KEY, {})
+
+  # Wait up to the given number of seconds for the newest request to be
+  # packed. Returns True if it has been
+  def wait(self, timeout):
+    return self.waitFor(lambda record: record.get('completed', 0) == record.get('requested', 0), timeout)
+
+  # Wait up to the given number of seconds for results that have not been
+  # reported yet (see takeResults()), which may mean waiting for the next
+  # request to be made and packed. Returns True if there are some
+  def waitForResults(self, timeout):
+    return self.waitFor(self.unreported, timeout)
+
+  # Wait up to the given number of seconds for ready(record) to return True
+  # for the record of the packing requests. Returns whether it did. While
+  # this process packs, it is woken up as soon as a packing finishes, and
+  # otherwise it checks the store now and then
+  def waitFor(self, ready, timeout):
+    deadline = time.time() + timeout
+    while True:
+      completions = self.completions
+      if ready(self.record()):
+        return True
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        return False
+      if self.isLeading():
+        # Look at the lease again now and then, in case it is lost
+        with self.completed:
+          self.completed.wait_for(lambda: self.completions != completions, min(remaining, LEASE_TTL / 4))
+      else:
+        time.sleep(min(remaining, POLL_INTERVAL))
+
+  # Returns True if the packer thread of this process holds the lease
+  def isLeading(self):
+    return self.leading and self.pid == os.getpid()
+
+  # Return the results of the newest request if it has been packed and
+  # they have not been reported before, and None otherwise. Each result is
+  # only ever reported once, however many processes ask for it
+  def takeResults(self):
+    # Check before taking the write lock, since this is polled often
+    if not self.unreported(self.record()):
+      return None
+
+    taken = []
+    def take(record):
+      if self.unreported(record):
+        record['reported'] = record['completed']
+        taken.append(record)
+      return record
+    self.state.update(PACKING_KEY, take, {})
+    return taken[0] if len(taken) > 0 else None
+
+  # Returns True if the newest request in the given record has been packed
+  # and its results have not been reported yet
+  def unreported(self, record):
+    completed = record.get('completed', 0)
+    return completed == record.get('requested', 0) and completed > record.get('reported', 0)
+
+  # Return the status of the packing requests
+  def status(self):
+    record = self.record()
+    running = record.get('completed', 0) != record.get('requested', 0)
+    if running:
+      state = 'running'
+    else:
+      state = 'failed' if record.get('error') else 'done'
+    return {
+      'state': state,
+      'generation': record.get('requested', 0),
+      'outputdir': self.packing.outputdir,
+      'previewdir': self.packing.previewdir,
+      'results': None if running else record.get('results'),
+      'error': None if running else record.get('error')
+    }
+
+  # Take or renew the lease, unless it was renewed recently. Returns True
+  # if this process holds the lease
+  def renewLease(self):
+    now = time.time()
+    if not self.leading or now - self.renewed >= LEASE_RENEWAL:
+      self.leading = self.state.acquireLease(LEASE_NAME, self.owner, LEASE_TTL)
+      self.renewed = now
+    return self.leading
+
+  # Body of the packer thread
+  def run(self):
+    while True:
+      try:
+        if self.renewLease():
+          record = self.record()
+          if record.get('requested', 0) > record.get('completed', 0):
+            self.pack(record)
+          self.runTasks()
+          self.sleep(IDLE_INTERVAL)
+        else:
+          # Another process packs. Check now and then whether it has stopped
+          time.sleep(LEASE_TTL / 4)
+      except Exception:
+        self.leading = False
+        traceback.print_exc()
+        time.sleep(POLL_INTERVAL)
+
+  # Pack the newest request in the given record
+  def pack(self, record):
+    generation = record['requested']
+    packing = self.packing
+    packing.generation = generation
+    print('[Packer] Packing generation {}'.format(generation))
+
+    resets = self.state.get(RESETS_KEY, 0)
+    if self.resets is not None and resets != self.resets:
+      packing.reset_cache()
+    self.resets = resets
+
+    # Keep the lease while packing, and let the packing know as soon as a
+    # newer request supersedes it
+    done = threading.Event()
+    monitor = threading.Thread(target=self.monitor, args=(done,), daemon=True)
+    monitor.start()
+    error = None
+    try:
+      packing.clearPreviews()
+      packing.loadFile(record['svgfile'], record['copies'])
+      if self.takeProfileRequest():
+        with self.profiler.profile('packing-{}'.format(generation)):
+          packing.doPacking(generation)
+      else:
+        packing.doPacking(generation)
+    except Exception as e:
+      traceback.print_exc()
+      error = '{}: {}'.format(type(e).__name__, e)
+    finally:
+      done.set()
+      monitor.join()
+
+    if packing.isStale(generation):
+      return
+
+    # The packing holds the results of an earlier generation if this one failed
+    results = packing.results() if error is None else None
+    def complete(record):
+      record['completed'] = max(record.get('completed', 0), generation)
+      record['results'] = results
+      record['error'] = error
+      return record
+    self.state.update(PACKING_KEY, complete, {})
+    with self.completed:
+      self.completions += 1
+      self.completed.notify_all()
+    if error is None:
+      print('[Packer] Finished packing generation {}'.format(generation))
+    else:
+      print('[Packer] Packing generation {} failed: {}'.format(generation, error))
+
+  # Return True if the next packing run should be profiled, and clear the request
+  def takeProfileRequest(self):
+    taken = []
+    def take(profile):
+      taken.append(profile)
+      return False
+    self.state.update(PROFILE_KEY, take, False)
+    return taken[0]
+
+  # Renew the lease, follow newer requests and keep running the tasks until
+  # done is set
+  def monitor(self, done):
+    while not done.wait(POLL_INTERVAL):
+      try:
+        self.renewLease()
+        requested = self.record().get('requested', 0)
+        if requested != self.packing.generation:
+          self.packing.generation = requested
+        self.runTasks()
+      except Exception:
+        traceback.print_exc()
+
+  # Run the functions added with addTask()
+  def runTasks(self):
+    for task in self.tasks:
+      task()
@@ -1,4 +1,5 @@
 from cairosvg import svg2png
+import fabricade_matdb
 import json
 import os
 from parse_materials import parse
@@ -57,6 +58,8 @@ def gen_db_from_file():
     with open('mat-data.txt', 'w') as outfile:
         json.dump(data, outfile)
 
+    fabricade_matdb.materialdb.importJSON('mat-data.txt')
+
 
 def updateViewbox():
     global materialinfo
@@ -0,0 +1,49 @@
+# Checks that the expat ingest of designs (PackingJob.readDesign, see
+# fabricade_ingest) produces exactly the same parts as the DOM-based
+# flattenSVGLayers() followed by splitMaterials(), part by part, for every
+# design in the corpus: the sample designs shipped in src and the designs
+# in tests/ingest, which cover nested layers, entities, titles, text, the
+# kinds of shapes and parts of unknown colours.
+#
+# Run from the root of the repository with:
+#   python3 -m pytest tests
+
+import collections
+import glob
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC = os.path.join(ROOT, 'src')
+sys.path.insert(0, SRC)
+
+CORPUS = [os.path.join(SRC, name) for name in ['cacheddoc.svg', 'MatDB.svg']] + sorted(glob.glob(os.path.join(ROOT, 'tests', 'ingest', '*.svg')))
+
+# The packing looks up its material database and colours relative to src
+@pytest.fixture
+def job(monkeypatch):
+  monkeypatch.chdir(SRC)
+  import fabricade_packing
+  job = fabricade_packing.PackingJob(workers=1)
+  # Parts of materials without a colour are still compared
+  job.colorsdb = collections.defaultdict(lambda: '#000000', job.colorsdb)
+  return job
+
+@pytest.mark.parametrize('copies', [1, 3])
+@pytest.mark.parametrize('filename', CORPUS, ids=os.path.basename)
+def test_ingest_matches_dom(job, filename, copies):
+  job.filename = filename
+  job.svginput = job.flattenSVGLayers()
+  expectedcuts, expectedcounts = job.splitMaterials(copies)
+  svginput, materialcuts, partcounts = job.readDesign(filename, copies)
+
+  assert svginput.cloneNode(False).toxml() == job.svginput.cloneNode(False).toxml()
+  assert list(materialcuts) == list(expectedcuts)
+  for material in expectedcuts:
+    expected = [part.toxml() for part in job.partsOf(expectedcuts[material])]
+    parts = [part.toxml() for part in job.partsOf(materialcuts[material])]
+    assert parts == expected, material
+    assert partcounts[material] == expectedcounts[material], material
+    assert materialcuts[material].cloneNode(False).toxml() == expectedcuts[material].cloneNode(False).toxml(), material